@@ -9,7 +9,7 @@ from mplutils import create_mpl_ax, new_lims
 from vizcol import cm_std
 #from gen.seq import ezip
 
-from alv.intv import rle
+from alv.intv import rle, Runs
 
 
 
@@ -25,10 +25,9 @@ def states(labels, sr, offset):
     """
 
 
-    df = pd.DataFrame(rle(np.asarray(labels, dtype='i2')),
-                        columns=['a', 'b', 'state'])
-    df['a'] += offset
-    df['b'] += offset
+    r = rle(np.asarray(labels, dtype='i2'))
+    df = pd.DataFrame({'a': r.starts + offset, 'b': r.stops + offset, 'state': r.values},
+                      columns=['a', 'b', 'state'])
 
     df['ds'] = df.b-df.a # in samples
     df['dtms'] = (1000./sr)*(df.b - df.a) # duration of interval *in ms*
@@ -36,7 +35,7 @@ def states(labels, sr, offset):
     return df
 
 
-def stack(x, Y, y0=0, dy=0, labels=None, colors=cm_std.colors,
+def stack(x, Y, y0=0, dy=0, labels=None, colors=None,
                  hlines=True, ax=None, **parts_kw):
     """Stack traces Y (NxT) around y0 with vertical spacing dy.
 
@@ -50,6 +49,8 @@ def stack(x, Y, y0=0, dy=0, labels=None, colors=cm_std.colors,
 
     if labels is None:
         labels = np.arange(Y.shape[0])
+    if colors is None:
+        colors = cm_std.colors
 
     for n, (y, col, label) in ezip(Y, colors, labels):
 
@@ -155,3 +156,170 @@ def ribbon(df, sr, colmap, y0, y_width,
     pl.setp(ax, **new_lims(ax, df[a].min()/sr, df[b].max()/sr,
                            y0-max_yw/2, y0+max_yw/2))
     return ax
+
+
+def pyramid(labels, base=16, chunk_size=1 << 22):
+    """Return the occupancy of each state in bins of base, 2*base, 4*base...
+    samples, as a list of (bin width, n_bins x n_states array of counts) from
+    the finest to a single bin, and the state of column 0.
+
+    Parameters
+    ----------
+    labels (ints) - state labels for each timestamp (Viterbi path), any
+      array (e.g. a memory map), read chunk_size samples at a time.
+    base (int) - width of the finest bins in samples.
+    """
+    lo, hi = int(np.min(labels)), int(np.max(labels))
+    n_states, n = hi - lo + 1, len(labels)
+    occ = np.zeros((-(-n // base), n_states), dtype=np.int32)
+    chunk_size = max(base, chunk_size - chunk_size % base)
+    for a in range(0, n, chunk_size):
+        x = np.asarray(labels[a:a + chunk_size], dtype=np.int64) - lo
+        bins = np.arange(x.size) // base
+        n_bins = bins[-1] + 1
+        occ[a // base:a // base + n_bins] += np.bincount(
+            bins * n_states + x, minlength=n_bins * n_states).reshape((n_bins, n_states))
+    levels = [(base, occ)]
+    while len(occ) > 1:
+        if len(occ) % 2:
+            occ = np.vstack((occ, np.zeros((1, n_states), dtype=occ.dtype)))
+        occ = occ.reshape((-1, 2, n_states)).sum(axis=1, dtype=np.int32)
+        levels.append((2 * levels[-1][0], occ))
+    return levels, lo
+
+
+def get_verts_rects(a, b, bottom, top):
+    """Return vertices of rectangles a..b x bottom..top in shape (npoly, 4, 2).
+    """
+    verts = np.empty((len(a), 4, 2))
+    verts[:, :, 0] = np.column_stack((a, b, b, a))
+    verts[:, :, 1] = np.column_stack(np.broadcast_arrays(bottom, bottom, top, top))
+    return verts
+
+
+class LodRibbon(object):
+    """Ribbon of the states of a long sequence (as ribbon) drawn at the level
+    of detail of the view: the runs themselves when there are no more than
+    about two per pixel, otherwise the bins of a pyramid (see pyramid) about
+    one pixel wide, showing their majority state or the occupancy of every
+    state. Only the view and one view width on each side are drawn, again
+    only once panning leaves them or zooming changes the level.
+
+    Parameters
+    ----------
+    labels (ints) - state labels for each timestamp (Viterbi path).
+    sr (float) - sampling rate in Hz.
+    colmap (function state -> color) : color map.
+    y0 (float) : ordinate of ribbon
+    y_width (float or dict) : height of ribbon (or of each state, 'majority' only)
+    ax (Axis) : axis to paint on
+    mode ('majority' or 'occupancy') : how bins of several states are shown
+    offset (int) : sample of the first label
+    base (int) : width of the finest bins of the pyramid in samples
+    ribbon_kw (dict) : passed to PolyCollection (e.g. use to set alpha)
+    """
+
+    def __init__(self, labels, sr, colmap, y0, y_width, ax=None, mode='majority',
+                 offset=0, base=16, legend_loc=0, **ribbon_kw):
+        from matplotlib.lines import Line2D
+        self.fig, self.ax = create_mpl_ax(ax)
+        if mode not in ('majority', 'occupancy'):
+            raise ValueError('unknown mode ' + mode)
+        labels = np.asarray(labels).ravel()
+        self.sr, self.y0, self.y_width, self.mode, self.offset = sr, y0, y_width, mode, offset
+        self.n = len(labels)
+        self.runs = Runs.encode(labels)
+        self.levels, self.lo = pyramid(labels, base)
+        self.drawn = None  # (level, first sample, last sample) of what is drawn
+
+        kw = dict(zorder=0, linewidths=0)
+        kw.update(**ribbon_kw)
+        self.collections = {}
+        proxy_artists = []
+        for state in np.unique(self.runs.values):
+            pc = mpl.collections.PolyCollection([], facecolors=colmap(state), **kw)
+            self.collections[state] = self.ax.add_collection(pc)
+            proxy_artists.append(Line2D([0], [0], linestyle="none", marker='o',
+                                        alpha=kw.get('alpha', 1), markersize=10,
+                                        markerfacecolor=colmap(state)))
+        if legend_loc:
+            artist = self.ax.legend(proxy_artists, sorted(self.collections), ncol=3,
+                                    loc=legend_loc)
+            self.ax.add_artist(artist)
+
+        try:
+            max_yw = max(y_width.values())
+        except AttributeError:
+            max_yw = y_width
+        pl.setp(self.ax, **new_lims(self.ax, offset / sr, (offset + self.n) / sr,
+                                    y0 - max_yw / 2, y0 + max_yw / 2))
+        # Functions, unlike bound methods, are strongly referenced by the callbacks
+        self._cids = (self.ax.callbacks.connect('xlim_changed', lambda ax: self.update()),
+                      self.fig.canvas.mpl_connect('resize_event', lambda event: self.update()))
+        self.update()
+
+    def remove(self):
+        """Remove the ribbon from its axes, e.g. to draw another one on them."""
+        self.ax.callbacks.disconnect(self._cids[0])
+        self.fig.canvas.mpl_disconnect(self._cids[1])
+        for pc in self.collections.values():
+            pc.remove()
+
+    def _height(self, state):
+        try:
+            return self.y_width[state]
+        except (TypeError, KeyError, IndexError):
+            return self.y_width
+
+    def update(self):
+        """Draw the view again if it is not what was drawn last."""
+        xmin, xmax = self.ax.get_xlim()
+        a = int(np.clip(np.floor(xmin * self.sr) - self.offset, 0, self.n))
+        b = int(np.clip(np.ceil(xmax * self.sr) - self.offset, a + 1, self.n))
+        pixels = max(self.ax.bbox.width, 1)
+        runs = (np.searchsorted(self.runs.starts, b) -
+                np.searchsorted(self.runs.stops, a, side='right'))
+        if runs <= 2 * pixels:
+            level = -1
+        else:
+            level = int(np.clip(np.log2((b - a) / pixels / self.levels[0][0]),
+                                0, len(self.levels) - 1))
+        if self.drawn and self.drawn[0] == level and self.drawn[1] <= a and b <= self.drawn[2]:
+            return
+        lo, hi = max(a - (b - a), 0), min(b + (b - a), self.n)
+        self.drawn = level, lo, hi
+        if level < 0 or self.mode == 'majority':
+            self._draw_runs(level, lo, hi)
+        else:
+            self._draw_occupancy(level, lo, hi)
+
+    def _bins(self, level, lo, hi):
+        width, occ = self.levels[level]
+        i = lo // width
+        edges = np.minimum(np.arange(i, -(-hi // width) + 1) * width, self.n)
+        return edges, occ[i:i + len(edges) - 1]
+
+    def _draw_runs(self, level, lo, hi):
+        if level < 0:
+            r = self.runs.window(lo, hi)
+        else:
+            edges, occ = self._bins(level, lo, hi)
+            r = Runs.encode(occ.argmax(axis=1) + self.lo)
+            r = Runs(edges[r.starts], edges[r.stops], r.values)
+        for state, pc in self.collections.items():
+            m = r.values == state
+            yw = self._height(state)
+            pc.set_verts(get_verts_rects((r.starts[m] + self.offset) / self.sr,
+                                         (r.stops[m] + self.offset) / self.sr,
+                                         self.y0 - yw / 2, self.y0 + yw / 2))
+
+    def _draw_occupancy(self, level, lo, hi):
+        edges, occ = self._bins(level, lo, hi)
+        frac = occ / np.maximum(occ.sum(axis=1), 1)[:, None]
+        bottom = self.y0 - self.y_width / 2 + self.y_width * (np.cumsum(frac, axis=1) - frac)
+        x = (edges + self.offset) / self.sr
+        for state, pc in self.collections.items():
+            c = state - self.lo
+            m = occ[:, c] > 0
+            pc.set_verts(get_verts_rects(x[:-1][m], x[1:][m], bottom[m, c],
+                                         bottom[m, c] + self.y_width * frac[m, c]))
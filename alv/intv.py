@@ -6,8 +6,12 @@ __copyright__  = "Public domain"
 __email__      = "alvaro at minin dot es"
 
 
-from itertools import izip, chain
+from itertools import chain, repeat
 import numpy as np
+try:
+    from itertools import izip
+except ImportError:  # Python 3
+    izip = zip
 
 
 def intervals(bds, lower=[], upper=[]):
@@ -37,20 +41,142 @@ def intervals(bds, lower=[], upper=[]):
                 chain(bds[1 - L:], upper))
 
 
+class Runs(object):
+    """Run-length encoded series as parallel arrays: run i spans the
+    samples starts[i] to stops[i] (excluded) with value values[i].
+    Runs are sorted and do not overlap.
+
+    Iterating yields (start, stop, value) tuples, like rle() always
+    did, so that Runs can be used wherever those tuples are expected.
+
+    >>> r = Runs.encode([1, 1, 1, 1, 1, 0, 0, 2, 2, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9])
+    >>> r.lengths
+    array([ 5,  2,  2, 10])
+    >>> list(r.window(3, 8))
+    [(3, 5, 1), (5, 7, 0), (7, 8, 2)]
+    """
+
+    def __init__(self, starts, stops, values):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.values = np.asarray(values)
+
+    @classmethod
+    def encode(cls, x):
+        """Return x run-length encoded."""
+        x = np.asarray(x)
+        if not x.size:
+            return cls([], [], x[:0])
+        jumps, = np.nonzero(x[1:] != x[:-1])
+        starts = np.concatenate(([0], jumps + 1))
+        return cls(starts, np.append(starts[1:], x.size), x[starts])
+
+    @classmethod
+    def from_tuples(cls, r):
+        """Return Runs from an iterable of (start, stop, value)."""
+        if isinstance(r, cls):
+            return r
+        starts, stops, values = zip(*r) or ((), (), ())
+        return cls(starts, stops, values)
+
+    def decode(self, dtype=None):
+        """Return normal (unwound) version, from starts[0] to stops[-1].
+        Samples in gaps between runs, if any, are left uninitialised.
+
+        >>> Runs([0, 5, 7], [5, 7, 9], [1, 0, 2]).decode()
+        array([1, 1, 1, 1, 1, 0, 0, 2, 2])
+        """
+        dtype = dtype or self.values.dtype
+        lengths = self.lengths
+        if not lengths.size:
+            return np.empty(0, dtype=dtype)
+        if np.all(self.starts[1:] == self.stops[:-1]):
+            return np.repeat(self.values.astype(dtype, copy=False), lengths)
+        arr = np.empty(self.stops[-1] - self.starts[0], dtype=dtype)
+        first = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        shift = np.repeat(self.starts - self.starts[0] - first, lengths)
+        arr[np.arange(lengths.sum()) + shift] = np.repeat(self.values, lengths)
+        return arr
+
+    @property
+    def lengths(self):
+        return self.stops - self.starts
+
+    def __len__(self):
+        return self.starts.size
+
+    def __iter__(self):
+        return izip(self.starts, self.stops, self.values)
+
+    def __getitem__(self, i):
+        """A (start, stop, value) tuple for an integer, Runs otherwise
+        (slice, boolean mask or array of indices)."""
+        if isinstance(i, (int, np.integer)):
+            return self.starts[i], self.stops[i], self.values[i]
+        return Runs(self.starts[i], self.stops[i], self.values[i])
+
+    def __repr__(self):
+        return 'Runs({!r}, {!r}, {!r})'.format(self.starts, self.stops, self.values)
+
+    def window(self, a, b):
+        """Return the runs within samples a to b (excluded), those
+        running over either end being cut there."""
+        i = np.searchsorted(self.stops, a, side='right')
+        j = np.searchsorted(self.starts, b, side='left')
+        return Runs(np.maximum(self.starts[i:j], a), np.minimum(self.stops[i:j], b),
+                    self.values[i:j])
+
+    @classmethod
+    def concatenate(cls, runs):
+        """Return the runs of the series concatenated one after the other:
+        each is shifted to start where the previous one stops, and equal
+        values meeting at the joins are merged into one run.
+
+        >>> list(Runs.concatenate([Runs.encode([1, 1, 2]), Runs.encode([2, 3])]))
+        [(0, 2, 1), (2, 4, 2), (4, 5, 3)]
+        """
+        runs = [cls.from_tuples(r) for r in runs]
+        runs = [r for r in runs if len(r)]
+        if not runs:
+            return cls([], [], [])
+        ends = np.cumsum([r.stops[-1] - r.starts[0] for r in runs])
+        shifts = np.concatenate(([0], ends[:-1])) - [r.starts[0] for r in runs]
+        starts = np.concatenate([r.starts + s for r, s in izip(runs, shifts)])
+        stops = np.concatenate([r.stops + s for r, s in izip(runs, shifts)])
+        values = np.concatenate([r.values for r in runs])
+        keep = np.concatenate(([True], (values[1:] != values[:-1]) |
+                               (starts[1:] != stops[:-1])))
+        last = np.append(np.nonzero(keep)[0][1:] - 1, values.size - 1)
+        return cls(starts[keep], stops[last], values[keep])
+
+    def dwell(self):
+        """Return dwell-time statistics of each value: dict of arrays
+        value, count (of runs), total, mean, std and max (of run lengths).
+
+        >>> Runs.encode([1, 1, 0, 1, 1, 1, 1]).dwell()['mean']
+        array([1., 3.])
+        """
+        value, inverse = np.unique(self.values, return_inverse=True)
+        lengths = self.lengths.astype(float)
+        count = np.bincount(inverse, minlength=value.size)
+        total = np.bincount(inverse, lengths, minlength=value.size)
+        mean = total / np.maximum(count, 1)
+        sq = np.bincount(inverse, lengths ** 2, minlength=value.size)
+        longest = np.zeros(value.size)
+        np.maximum.at(longest, inverse, lengths)
+        return {'value': value, 'count': count, 'total': total, 'mean': mean,
+                'std': np.sqrt(np.maximum(sq / np.maximum(count, 1) - mean ** 2, 0)),
+                'max': longest}
+
+
 def rle(x):
     """
-    Return x run-length encoded: iterator over (start, stop, value).
+    Return x run-length encoded: Runs, iterable over (start, stop, value).
 
-    From
-    http://mail.scipy.org/pipermail/numpy-discussion/2007-October/029378.html
     >>> list(rle([1,1,1,1,1,0,0,2,2,9,9,9,9,9,9,9,9,9,9]))
     [(0, 5, 1), (5, 7, 0), (7, 9, 2), (9, 19, 9)]"""
 
-    jumps, = np.nonzero(np.diff(np.asarray(x)))
-    # add boundaries 0 and last
-    jumps = np.concatenate(([0], jumps + 1, [len(x)]))
-
-    return ((a, b, x[a]) for (a, b) in izip(jumps[:-1], jumps[1:]))
+    return Runs.encode(x)
 
 
 def unrle(r, dtype=None):
@@ -62,19 +188,11 @@ def unrle(r, dtype=None):
     array([1, 1, 1, 1, 1, 0, 0, 2, 2, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9])
     """
 
-    tuples = list(r)
-    _, totlen, el = tuples[-1]
-
-    if not dtype:
-        # if not dtype passed, this will be generous
-        # (any integer will result in int64, any float in float64, etc)
-        dtype = np.dtype(type(el))
-
-    arr = np.empty(totlen, dtype=dtype)
-
-    for (a, b, el) in tuples:
-        arr[a:b] = el
-
+    r = Runs.from_tuples(r)
+    if not r.starts.size or r.starts[0] == 0:
+        return r.decode(dtype)
+    arr = np.empty(r.stops[-1], dtype=dtype or r.values.dtype)
+    arr[r.starts[0]:] = r.decode(dtype)
     return arr
 
 
@@ -86,13 +204,7 @@ def iunrle(r):
     [1, 1, 1, 1, 1, 0, 0, 2, 2, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9]
     """
 
-    if type(r) == type(list()):
-        r = (x for x in r)
-
-    while 1:
-        a, b, el = r.next()
-        for i in xrange(b - a):
-            yield el
+    return chain.from_iterable(repeat(el, b - a) for a, b, el in r)
 
 
 
@@ -1,10 +1,20 @@
-import matplotlib.pyplot as pl
+import matplotlib as mpl
 from matplotlib.colors import ListedColormap
 
 ##
 # Predefined colormaps
 ##
-standard_color_list = pl.rcParams['axes.color_cycle']
+def standard_colors():
+    """Return the colors of the current style (without pyplot). Those of
+    standard_color_list are read at import: call this to follow later style
+    changes."""
+    try:
+        return [c['color'] for c in mpl.rcParams['axes.prop_cycle']]
+    except KeyError: # matplotlib < 1.5
+        return mpl.rcParams['axes.color_cycle']
+
+
+standard_color_list = standard_colors()
 
 # up to 10 cycles
 cm_std = ListedColormap(standard_color_list, N=len(standard_color_list)*10)
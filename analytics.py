@@ -0,0 +1,223 @@
+# coding=utf-8
+"""
+Dwell times, transition counts and occupancy of the states of Viterbi paths, per trial and
+across trials, computed from the run-length encoded paths (see alv.intv.Runs).
+
+Paths are read in chunks, e.g. from a memory map, and the statistics are accumulated as
+runs end, so that long paths are never held in memory or expanded into Python objects.
+Only compact tables are written:
+
+    python analytics.py -i <viterbi-file> -o <output-prefix> [-t <trials>] [-r <rate>]
+
+with <viterbi-file> either the .npy saved next to the output file by main.py (states
+starting at 1) or the observations file written by main.py --decode (lengths included).
+The tables are <output-prefix>.states.csv (occupancy and dwell times per trial and
+state), .transitions.csv (counts of transitions between states per trial, including
+self-transitions) and .dwell.csv (histogram of dwell times of each state, all trials).
+"""
+from __future__ import print_function, division
+import getopt
+import sys
+import numpy as np
+import pandas as pd
+from alv.intv import Runs
+import obsfile
+
+
+class PathStats(object):
+    """
+    Usage:
+        s = PathStats(n_states, lengths)
+        for chunk in chunks:  # Consecutive pieces of the concatenated paths
+            s.update(chunk)
+        s.close()
+        s.states_table()
+
+    Parameters
+    ----------
+    n_states: number of states, numbered from 0
+    lengths: lengths of the trials of the concatenated paths
+    max_dwell: dwell times from max_dwell samples on are counted together in the histogram
+    """
+
+    def __init__(self, n_states, lengths, max_dwell=1000):
+        self.n_states = n_states
+        self.offsets = obsfile.offsets(lengths)
+        self.max_dwell = max_dwell
+        T, K = len(lengths), n_states
+        self.occupancy = np.zeros((T, K), dtype=np.int64)
+        self.runs = np.zeros((T, K), dtype=np.int64)
+        self.dwell_sq = np.zeros((T, K))
+        self.longest = np.zeros((T, K), dtype=np.int64)
+        self.transitions = np.zeros((T, K, K), dtype=np.int64)
+        self.histogram = np.zeros((K, max_dwell + 1), dtype=np.int64)
+        self.position = 0
+        self._pending = None  # Last run seen, which may go on in the next chunk
+        self._last = None  # (trial, state) of the last run accounted for
+
+    def update(self, chunk):
+        """ Adds the next samples of the concatenated paths. """
+        chunk = np.asarray(chunk)
+        if not chunk.size:
+            return
+        r = Runs.encode(chunk)
+        starts, stops = r.starts + self.position, r.stops + self.position
+        self.position += chunk.size
+        # Cut runs at the start of trials
+        cuts = np.union1d(starts, self.offsets[(self.offsets > starts[0]) &
+                                               (self.offsets < self.position)])
+        values = r.values[np.searchsorted(starts, cuts, side='right') - 1].astype(np.int64)
+        stops = np.append(cuts[1:], self.position)
+        starts = cuts
+        if self._pending is not None:
+            start, _, value = self._pending
+            if value == values[0] and starts[0] not in self.offsets:
+                starts[0] = start
+            else:
+                self._account(np.array([start]), np.array([starts[0]]), np.array([value]))
+        self._pending = starts[-1], stops[-1], values[-1]
+        self._account(starts[:-1], stops[:-1], values[:-1])
+
+    def close(self):
+        """ Accounts for the last run, once all samples have been added. """
+        if self._pending is not None:
+            start, stop, value = self._pending
+            self._account(np.array([start]), np.array([stop]), np.array([value]))
+            self._pending = None
+
+    def _account(self, starts, stops, values):
+        """ Adds complete runs, in order, to the statistics. """
+        if not starts.size:
+            return
+        K = self.n_states
+        trials = np.searchsorted(self.offsets, starts, side='right') - 1
+        lengths = stops - starts
+        cell = trials * K + values
+        size = self.occupancy.size
+        self.occupancy += np.bincount(cell, lengths, size).astype(np.int64).reshape((-1, K))
+        self.runs += np.bincount(cell, minlength=size).reshape((-1, K))
+        self.dwell_sq += np.bincount(cell, lengths.astype(float) ** 2, size).reshape((-1, K))
+        np.maximum.at(self.longest.reshape(-1), cell, lengths)
+        np.add.at(self.histogram, (values, np.minimum(lengths, self.max_dwell)), 1)
+        # Self-transitions within runs, and transitions between consecutive runs of a trial
+        self.transitions.reshape((-1, K * K))[:, ::K + 1] += np.bincount(
+            cell, lengths - 1, size).astype(np.int64).reshape((-1, K))
+        seq_trials, seq_values = trials, values
+        if self._last is not None:
+            seq_trials = np.append(self._last[0], trials)
+            seq_values = np.append(self._last[1], values)
+        same = seq_trials[1:] == seq_trials[:-1]
+        np.add.at(self.transitions, (seq_trials[1:][same], seq_values[:-1][same],
+                                     seq_values[1:][same]), 1)
+        self._last = trials[-1], values[-1]
+
+    def states_table(self, rate=None):
+        """
+        DataFrame with one row per trial and state: occupancy (samples), fraction of the
+        trial, runs, mean, std and max dwell time (samples, and ms given the sampling rate
+        in Hz as for alv.hmm_viz.states). Trial 'all' sums up all trials.
+        """
+        T, K = self.occupancy.shape
+        rows = []
+        for trial, occ, runs, sq, longest in zip(list(range(T)) + ['all'],
+                                                 np.vstack((self.occupancy, self.occupancy.sum(0))),
+                                                 np.vstack((self.runs, self.runs.sum(0))),
+                                                 np.vstack((self.dwell_sq, self.dwell_sq.sum(0))),
+                                                 np.vstack((self.longest, self.longest.max(0)))):
+            mean = occ / np.maximum(runs, 1)
+            std = np.sqrt(np.maximum(sq / np.maximum(runs, 1) - mean ** 2, 0))
+            for state in range(K):
+                rows.append((trial, state, occ[state], occ[state] / max(occ.sum(), 1), runs[state],
+                             mean[state], std[state], longest[state]))
+        df = pd.DataFrame(rows, columns=['trial', 'state', 'occupancy', 'fraction', 'runs',
+                                         'mean_dwell', 'std_dwell', 'max_dwell'])
+        if rate:
+            for col in ('mean_dwell', 'std_dwell', 'max_dwell'):
+                df[col + '_ms'] = (1000. / rate) * df[col]
+        return df
+
+    def transitions_table(self):
+        """ DataFrame of the non-zero transition counts, per trial and for 'all' trials. """
+        counts = np.concatenate((self.transitions, self.transitions.sum(0)[None]))
+        trial, a, b = np.nonzero(counts)
+        trial = np.where(trial == len(self.transitions), 'all', trial.astype(str))
+        return pd.DataFrame({'trial': trial, 'from': a, 'to': b, 'count': counts[np.nonzero(counts)]},
+                            columns=['trial', 'from', 'to', 'count'])
+
+    def dwell_table(self):
+        """ DataFrame of the non-zero counts of the dwell histogram of each state. """
+        state, dwell = np.nonzero(self.histogram)
+        return pd.DataFrame({'state': state, 'dwell': dwell, 'count': self.histogram[state, dwell]},
+                            columns=['state', 'dwell', 'count'])
+
+
+def path_stats(path, lengths, n_states=None, chunk_size=1 << 20, shift=0, max_dwell=1000):
+    """
+    Statistics of the concatenated Viterbi paths (any array, e.g. a memory map) of trials of
+    the given lengths, read chunk_size samples at a time. shift is added to the states,
+    e.g. -1 for paths saved starting at 1.
+    """
+    if n_states is None:
+        n_states = int(np.max(path)) + shift + 1
+    s = PathStats(n_states, lengths, max_dwell)
+    for a in range(0, len(path), chunk_size):
+        s.update(np.asarray(path[a:a + chunk_size]).astype(np.int64) + shift)
+    s.close()
+    return s
+
+
+def load_path(path, trials=1):
+    """
+    Returns the paths (a memory map) in a file saved by main.py, the lengths of the trials
+    (from the file, or trials of equal length) and the shift to states numbered from 0.
+    """
+    if obsfile.is_obsfile(path):
+        series, header = obsfile.load(path)
+        return series, header['lengths'], 0
+    series = np.load(path, mmap_mode='r')
+    if series.size % trials:
+        raise ValueError('Length of the paths is not a multiple of the number of trials')
+    return series, np.full(trials, series.size // trials, dtype=int), -1
+
+
+def main(argv):
+    usage_str = str(
+        "Usage: python analytics.py -i <viterbi-file> -o <output-prefix>\n\nOther options:\n"
+        "    -h, --help           This help\n"
+        "    -t, --trials         Number of trials of equal length in a .npy file\n"
+        "                         [default=1]\n"
+        "    -r, --rate           Sampling rate in Hz, to add dwell times in ms\n"
+        "        --max-dwell      Longest dwell time of the histograms [default=1000]")
+    try:
+        vals, args = getopt.getopt(argv, 'hi:o:t:r:', ['help', 'input-file=', 'output-prefix=',
+                                                       'trials=', 'rate=', 'max-dwell='])
+    except getopt.GetoptError as error:
+        print('ERROR: ' + error.msg + '\n' + usage_str)
+        sys.exit(2)
+    input_file, prefix, trials, rate, max_dwell = None, None, 1, None, 1000
+    for opt, arg in vals:
+        if opt in ('-h', '--help'):
+            print(usage_str)
+            sys.exit()
+        elif opt in ('-i', '--input-file'):
+            input_file = arg
+        elif opt in ('-o', '--output-prefix'):
+            prefix = arg
+        elif opt in ('-t', '--trials'):
+            trials = int(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt == '--max-dwell':
+            max_dwell = int(arg)
+    if not input_file or not prefix:
+        print('ERROR: input file and output prefix required\n' + usage_str)
+        sys.exit(1)
+    series, lengths, shift = load_path(input_file, trials)
+    s = path_stats(series, lengths, shift=shift, max_dwell=max_dwell)
+    s.states_table(rate).to_csv(prefix + '.states.csv', index=False)
+    s.transitions_table().to_csv(prefix + '.transitions.csv', index=False)
+    s.dwell_table().to_csv(prefix + '.dwell.csv', index=False)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
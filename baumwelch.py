@@ -0,0 +1,1331 @@
+# coding=utf-8
+"""
+Batched Baum-Welch for HMMs with categorical emissions.
+
+Trials of equal length are stacked into one (T, trials) array and processed together
+by scaled forward-backward recursions (see Rabiner [1], section V.A), so that the
+loop over time is paid once per iteration instead of once per trial. The interface
+mimics hmmlearn.hmm.MultinomialHMM so that both can be used interchangeably in main.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import obsfile
+
+
+def check_random_state(seed):
+    """ Same semantics as sklearn.utils.check_random_state """
+    if seed is None or seed is np.random:
+        return np.random.mtrand._rand
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def normalize(a, axis=None):
+    """ Normalizes a in place to sum to one along axis, leaving all-zero slices untouched. """
+    a_sum = a.sum(axis, keepdims=True)
+    a_sum[a_sum == 0] = 1
+    a /= a_sum
+    return a
+
+
+def as_batches(X, lengths=None):
+    """
+    Groups the trials of a concatenated series into blocks of equal length.
+
+    Parameters
+    ----------
+    X: array of symbols, either N or N x 1
+    lengths: lengths of individual trials, or None for a single one
+
+    Returns
+    -------
+    List of (indices, block) with indices the positions of the trials in lengths and
+    block a (T, len(indices)) array with one trial per column.
+    """
+    X = np.asarray(X).ravel()
+    if lengths is None:
+        lengths = [X.size]
+    lengths = np.asarray(lengths, dtype=int)
+    ends = np.cumsum(lengths)
+    if ends[-1] != X.size:
+        raise ValueError('Lengths add up to {}, but there are {} samples'.format(ends[-1], X.size))
+    starts = ends - lengths
+    batches = []
+    for T in np.unique(lengths):
+        idx, = np.nonzero(lengths == T)
+        if np.all(np.diff(starts[idx]) == T):  # Contiguous: reshape without copying
+            block = X[starts[idx[0]]:ends[idx[-1]]].reshape((idx.size, T)).T
+        else:
+            block = np.stack([X[starts[i]:ends[i]] for i in idx], axis=1)
+        batches.append((idx, np.ascontiguousarray(block)))
+    return batches
+
+
+def split_batches(batches, n):
+    """ Splits the trials of each batch from as_batches() into at most n shards of batches. """
+    shards = [[] for _ in range(n)]
+    for idx, X in batches:
+        for shard, cols in zip(shards, np.array_split(np.arange(idx.size), n)):
+            if cols.size:
+                shard.append((idx[cols], np.ascontiguousarray(X[:, cols])))
+    shards.sort(key=lambda shard: -sum(X.size for _, X in shard))
+    return [shard for shard in shards if shard]
+
+
+class SparseTransmat(object):
+    """
+    Transition matrices (..., K, K) with few non-zero entries, stored as the predecessors
+    (prev, prev_prob) and successors (next, next_prob) of each state: (..., K, width) arrays
+    padded with probability 0. The recursions then cost O(K x width) per time step instead
+    of O(K²). See as_transitions().
+    """
+
+    def __init__(self, transmat):
+        self.prev, self.prev_prob = _adjacency(np.swapaxes(transmat, -1, -2))
+        self.next, self.next_prob = _adjacency(transmat)
+        self._gather = {}
+
+    def dot(self, v, transpose=False):
+        """ Returns v x transmat (or v x transmat.T) for row vectors v (..., trials, K). """
+        key = transpose, v.shape
+        if key not in self._gather:  # Positions in v.ravel() of the terms of each product
+            idx, val = (self.next, self.next_prob) if transpose else (self.prev, self.prev_prob)
+            shape = idx.shape[:-2] + (1,) * (v.ndim - idx.ndim + 1) + idx.shape[-2:]
+            rows = np.arange(0, v.size, v.shape[-1]).reshape(v.shape[:-1])
+            self._gather[key] = rows[..., None, None] + idx.reshape(shape), val.reshape(shape)
+        idx, val = self._gather[key]
+        return np.einsum('...i,...i->...', np.take(v, idx), val)
+
+
+def _adjacency(a):
+    """ Indices and values of the non-zero entries in each row of a, padded to the same width. """
+    width = max(int((a != 0).sum(axis=-1).max()), 1)
+    idx = np.argsort(a == 0, axis=-1, kind='mergesort')[..., :width]
+    return idx, np.take_along_axis(a, idx, axis=-1)
+
+
+def as_transitions(transmat, max_density=0.1):
+    """
+    Returns transmat as a SparseTransmat if no state has more than max_density x K
+    predecessors or successors, and as is otherwise.
+    """
+    K = transmat.shape[-1]
+    nz = transmat != 0
+    if max(nz.sum(axis=-1).max(), nz.sum(axis=-2).max()) > max_density * K:
+        return transmat
+    return SparseTransmat(transmat)
+
+
+def prune_transitions(transmat, n_transitions=None, threshold=0.):
+    """
+    Sets to 0 all but the n_transitions most likely transitions out of each state, and
+    those with a probability below threshold (though the most likely one is always kept).
+    Returns the renormalised matrices.
+    """
+    transmat = transmat.copy()
+    if threshold:
+        transmat[(transmat < threshold) & (transmat < transmat.max(axis=-1, keepdims=True))] = 0
+    if n_transitions is not None and n_transitions < transmat.shape[-1]:
+        drop = np.argsort(transmat, axis=-1)[..., :-n_transitions]
+        np.put_along_axis(transmat, drop, 0, axis=-1)
+    return normalize(transmat, axis=-1)
+
+
+def forward(framelik, startprob, transmat):
+    """
+    Scaled forward recursion over a block of trials.
+
+    Parameters
+    ----------
+    framelik: (T, trials, n_states) emission likelihoods, i.e. emissionprob.T[X]. Several
+              models can be run at once with a (T, models, trials, n_states) array and
+              parameters stacked along a first axis (see CategoricalHMM._do_estep)
+    startprob, transmat: model parameters, transmat possibly a SparseTransmat
+
+    Returns
+    -------
+    alpha: forward variables, normalised at each time step. Same shape as framelik
+    scale: (T, [models,] trials) scaling coefficients. The log-likelihood of each trial is
+           np.log(scale).sum(axis=0)
+    """
+    alpha = np.empty(framelik.shape)
+    scale = np.empty(framelik.shape[:-1])
+    np.multiply(startprob, framelik[0], out=alpha[0])
+    for t in range(framelik.shape[0]):
+        if t > 0:
+            if isinstance(transmat, SparseTransmat):
+                alpha[t] = transmat.dot(alpha[t - 1])
+            else:
+                np.matmul(alpha[t - 1], transmat, out=alpha[t])
+            alpha[t] *= framelik[t]
+        c = alpha[t].sum(axis=-1)
+        scale[t] = c
+        c[c == 0] = 1  # Impossible observation: scale is 0 and the likelihood -inf
+        alpha[t] /= c[..., None]
+    return alpha, scale
+
+
+def backward(framelik, transmat, scale, last=1):
+    """
+    Scaled backward recursion, using the coefficients computed by forward().
+    last: backward variables of the last sample, if the sequence goes on after it
+
+    Returns
+    -------
+    beta: backward variables, same shape as framelik
+    """
+    beta = np.empty(framelik.shape)
+    beta[-1] = last
+    c = np.where(scale == 0, 1, scale)[..., None]
+    b = np.empty(framelik.shape[1:])
+    sparse = isinstance(transmat, SparseTransmat)
+    if not sparse:
+        transmat_t = transmat.swapaxes(-1, -2)
+    for t in range(framelik.shape[0] - 2, -1, -1):
+        np.multiply(framelik[t + 1], beta[t + 1], out=b)
+        b /= c[t + 1]
+        if sparse:
+            beta[t] = transmat.dot(b, transpose=True)
+        else:
+            np.matmul(b, transmat_t, out=beta[t])
+    return beta
+
+
+def viterbi(framelogprob, startprob, transmat):
+    """
+    Log-space Viterbi decoding of a block of trials.
+
+    Parameters
+    ----------
+    framelogprob: (T, trials, n_states) emission log-likelihoods
+    startprob, transmat: model parameters, transmat possibly a SparseTransmat
+
+    Returns
+    -------
+    path: (T, trials) most likely state sequences
+    logprob: (trials,) log-probabilities of the paths
+    """
+    T, n, K = framelogprob.shape
+    psi = np.empty((T, n, K), dtype=np.min_scalar_type(K))
+    with np.errstate(divide='ignore'):
+        delta = np.log(startprob) + framelogprob[0]
+    step = _viterbi_step(transmat)
+    for t in range(1, T):
+        psi[t], delta = step(delta)
+        delta += framelogprob[t]
+    path = np.empty((T, n), dtype=int)
+    path[-1] = delta.argmax(axis=1)
+    cols = np.arange(n)
+    for t in range(T - 1, 0, -1):
+        path[t - 1] = psi[t, cols, path[t]]
+    return path, delta.max(axis=1)
+
+
+def _viterbi_step(transmat):
+    """
+    Returns a function of the log-probabilities delta (..., K) of the best paths ending in
+    each state, which gives the best predecessor of each state and the log-probabilities
+    of the best paths one step later (before emission).
+    """
+    with np.errstate(divide='ignore'):
+        if not isinstance(transmat, SparseTransmat):
+            logA = np.log(transmat)
+
+            def step(delta):
+                s = delta[..., None] + logA
+                return s.argmax(axis=-2), s.max(axis=-2)
+        else:
+            prev, logp = transmat.prev, np.log(transmat.prev_prob)
+
+            def step(delta):
+                s = delta[..., prev] + logp
+                q = s.argmax(axis=-1)
+                return np.take_along_axis(np.broadcast_to(prev, s.shape), q[..., None],
+                                          axis=-1)[..., 0], s.max(axis=-1)
+    return step
+
+
+def stream_viterbi(chunks, startprob, transmat, emissionprob, max_window=1 << 20):
+    """
+    Online Viterbi decoding of one sequence read in chunks, with bounded memory.
+
+    Back-pointers are only kept for the samples whose state is still undecided. After
+    each chunk, the paths ending in every state are traced back until they merge: the
+    best path will go through that point whatever comes next, so everything up to it is
+    final and yielded. Memory is O(n_states x window), where the window is the span of
+    undecided samples. Should paths not merge within max_window samples, the older half
+    of the window is committed following the currently best state, and the result may
+    then differ from the exact Viterbi path.
+
+    Parameters
+    ----------
+    chunks: iterable of arrays of symbols
+    startprob, transmat, emissionprob: model parameters (transmat is used as a SparseTransmat
+                                       if sparse enough, see as_transitions())
+    max_window: maximum number of undecided samples
+
+    Yields
+    ------
+    Consecutive segments of the most likely state sequence
+    """
+    K = transmat.shape[0]
+    with np.errstate(divide='ignore'):
+        logB, logpi = np.log(emissionprob.T), np.log(startprob)
+    step = _viterbi_step(as_transitions(transmat))
+    dtype = np.min_scalar_type(K)
+    delta = None
+    psi = np.empty((0, K), dtype=dtype)  # psi[i, j]: best predecessor of state j at sample i
+    for chunk in chunks:
+        framelogprob = logB[np.asarray(chunk)]
+        p = np.zeros((len(framelogprob), K), dtype=dtype)
+        for t in range(len(framelogprob)):
+            if delta is None:
+                delta = logpi + framelogprob[t]
+                continue
+            p[t], delta = step(delta)
+            delta += framelogprob[t]
+        psi = np.concatenate((psi, p))
+        anc = np.arange(K)
+        t = len(psi) - 1
+        while t > 0 and np.any(anc != anc[0]):
+            anc = psi[t, anc]
+            t -= 1
+        if np.all(anc == anc[0]):
+            yield _backtrack(psi[:t + 1], anc[0])
+            psi = psi[t + 1:]
+        elif len(psi) > max_window:
+            t = len(psi) // 2
+            path = _backtrack(psi, delta.argmax())
+            yield path[:t]
+            psi = psi[t:]
+    if delta is not None and len(psi):
+        yield _backtrack(psi, delta.argmax())
+
+
+def _backtrack(psi, last):
+    """ State sequence for the samples in psi, ending in state last. """
+    path = np.empty(len(psi), dtype=int)
+    path[-1] = last
+    for t in range(len(psi) - 1, 0, -1):
+        path[t - 1] = psi[t, path[t]]
+    return path
+
+
+def as_runs(runs, lengths=None):
+    """
+    Prepares run-length encoded trials for CategoricalHMM.fit_runs and score_runs.
+
+    Parameters
+    ----------
+    runs: alv.intv.Runs covering the concatenated trials, as from alv.intv.rle(series), or
+          any iterable of (start, stop, value). Runs going over the end of a trial are
+          split there.
+    lengths: lengths of individual trials, or None for a single one
+
+    Returns
+    -------
+    values, run lengths, and trial of each run
+    """
+    if hasattr(runs, 'starts'):  # alv.intv.Runs
+        starts, stops, values = runs.starts, runs.stops, runs.values.astype(np.int64)
+    else:
+        starts, stops, values = np.array(list(runs), dtype=np.int64).reshape((-1, 3)).T
+    if not starts.size or starts[0] != 0 or np.any(starts[1:] != stops[:-1]):
+        raise ValueError('Runs must cover the series from its first sample on')
+    total = stops[-1]
+    offsets = np.concatenate(([0], np.cumsum([total] if lengths is None else lengths)))
+    if offsets[-1] != total:
+        raise ValueError('Lengths add up to {}, but there are {} samples'.format(offsets[-1], total))
+    cuts = np.union1d(starts, offsets[:-1])
+    values = values[np.searchsorted(starts, cuts, side='right') - 1]
+    trials = np.searchsorted(offsets, cuts, side='right') - 1
+    return values, np.diff(np.append(cuts, total)), trials
+
+
+class RunPowers(object):
+    """
+    Cache of the powers M_o^L of M_o = transmat x diag(emissionprob[:, o]), which take the
+    forward variables over a run of L samples of symbol o in one product.
+
+    With sums=True, the cache also holds for each run the K x K x K x K tensor
+    S[a, b, i, j] = sum_k M^k[a, i] M^(L-1-k)[j, b], from which the expected transitions
+    within the run follow (see CategoricalHMM._do_estep_runs). Entries are built from the
+    powers of 2 of each M_o, in O(log L) products of O(K³) (O(K⁵) with sums).
+
+    Powers are scaled: get() returns (P, S, log_scale) with M^L = P x exp(log_scale), and
+    S scaled alike.
+    """
+
+    def __init__(self, transmat, emissionprob, sums=False):
+        self.transmat, self.emissionprob = transmat, emissionprob
+        self.sums = sums
+        self.squares = {}
+        self.cache = {}
+
+    def _join(self, x, y):
+        """ Powers for the concatenation of two runs of the same symbol. """
+        P1, S1, l1 = x
+        P2, S2, l2 = y
+        P = P1.dot(P2)
+        S = None
+        if self.sums:
+            S = (np.tensordot(S1, P2, axes=([1], [0])).transpose(0, 3, 1, 2) +
+                 np.tensordot(P1, S2, axes=([1], [0])))
+        s = P.max()
+        if s > 0:
+            P /= s
+            if self.sums:
+                S /= s
+        return P, S, l1 + l2 + (np.log(s) if s > 0 else 0)
+
+    def get(self, o, L):
+        if (o, L) in self.cache:
+            return self.cache[o, L]
+        K = self.transmat.shape[0]
+        squares = self.squares.setdefault(o, [])
+        if not squares:
+            I = np.eye(K)
+            squares.append(self._join((np.eye(K), np.zeros((K, K, K, K)) if self.sums else None, 0),
+                                      (self.transmat * self.emissionprob[:, o],
+                                       I[:, None, :, None] * I[None, :, None, :] if self.sums
+                                       else None, 0)))
+        while 1 << len(squares) <= L:
+            squares.append(self._join(squares[-1], squares[-1]))
+        result = None
+        for m, square in enumerate(squares):
+            if L >> m & 1:
+                result = square if result is None else self._join(result, square)
+        if result is None:
+            result = np.eye(K), np.zeros((K, K, K, K)) if self.sums else None, 0.
+        self.cache[o, L] = result
+        return result
+
+
+def forward_runs(values, run_lengths, trials, startprob, emissionprob, powers):
+    """
+    Scaled forward recursion over the runs of every trial, one run at a time.
+
+    Parameters
+    ----------
+    values, run_lengths, trials: runs as returned by as_runs()
+    startprob, emissionprob: model parameters
+    powers: RunPowers of the model
+
+    Returns
+    -------
+    u: (trials, max. runs + 1, K) normalised forward variables at the end of the first
+       sample of each trial, then at the end of each run
+    logprob: (trials,) log-likelihoods
+    index: (trials, max. runs) run at each position, -1 past the last run of a trial
+    steps: (runs,) number of samples each run takes the forward variables through (one
+           less than its length for the first run of a trial, whose first sample is
+           accounted for by startprob)
+    """
+    first = np.ones(values.size, dtype=bool)
+    first[1:] = trials[1:] != trials[:-1]
+    steps = run_lengths - first
+    n = trials[-1] + 1
+    pos = np.arange(values.size) - np.flatnonzero(first)[trials]
+    index = np.full((n, pos.max() + 1), -1)
+    index[trials, pos] = np.arange(values.size)
+    u = np.zeros((n, index.shape[1] + 1, startprob.size))
+    u[:, 0] = startprob * emissionprob[:, values[first]].T
+    c = u[:, 0].sum(axis=1)
+    u[:, 0] /= c[:, None]
+    with np.errstate(divide='ignore'):
+        logprob = np.log(c)
+    for r in range(index.shape[1]):
+        act, = np.nonzero(index[:, r] >= 0)
+        runs = index[act, r]
+        P = [powers.get(values[j], steps[j]) for j in runs]
+        w = np.einsum('nk,nkl->nl', u[act, r], np.array([p[0] for p in P]))
+        c = w.sum(axis=1)
+        u[act, r + 1] = w / np.where(c == 0, 1, c)[:, None]
+        with np.errstate(divide='ignore'):
+            logprob[act] += np.log(c) + [p[2] for p in P]
+    return u, logprob, index, steps
+
+
+def _product(a, b, maxplus=False):
+    """ Products a x b of stacked matrices, scaled to a maximum of 1, and the logs of the scales. """
+    if maxplus:
+        p = (a[..., :, :, None] + b[..., None, :, :]).max(axis=-2)
+        s = p.max(axis=(-2, -1))
+        s[~np.isfinite(s)] = 0
+        return p - s[..., None, None], s
+    p = np.matmul(a, b)
+    s = p.max(axis=(-2, -1))
+    s[s == 0] = 1
+    return p / s[..., None, None], np.log(s)
+
+
+def transfer(X, transmat, emissionprob, maxplus=False):
+    """
+    Product over the samples x of X of transmat x diag(emissionprob[:, x]), i.e. the matrix
+    taking the forward variables from before X to its last sample, by pairwise products
+    in log2(len(X)) vectorised steps (a parallel prefix reduction).
+
+    Parameters
+    ----------
+    X: symbols
+    transmat, emissionprob: model parameters, possibly stacked (..., K, K) and (..., K, M)
+    maxplus: transmat and emissionprob are logs and the product is taken in the max-plus
+             semiring, for Viterbi
+
+    Returns
+    -------
+    The product, scaled to a maximum of 1 (0 with maxplus), and the log of the scale
+    """
+    K = transmat.shape[-1]
+    size = max(1, (1 << 22) // K ** (3 if maxplus else 2))  # Bounds memory to ~32MB per model
+    B = np.moveaxis(emissionprob, -1, 0)
+    result = None
+    for a in range(0, len(X), size):
+        b = B[np.asarray(X[a:a + size])]
+        M = transmat + b[..., None, :] if maxplus else transmat * b[..., None, :]
+        logscale = np.zeros(M.shape[:-2])
+        while len(M) > 1:
+            n = len(M) // 2 * 2
+            P, s = _product(M[0:n:2], M[1:n:2], maxplus)
+            s += logscale[0:n:2] + logscale[1:n:2]
+            M, logscale = np.concatenate((P, M[n:])), np.concatenate((s, logscale[n:]))
+        if result is None:
+            result = M[0], logscale[0]
+        else:
+            P, s = _product(result[0], M[0], maxplus)
+            result = P, s + result[1] + logscale[0]
+    if result is None:
+        I = np.broadcast_to(np.eye(K), transmat.shape)
+        return (np.where(I == 1, 0, -np.inf) if maxplus else I.copy()), np.zeros(transmat.shape[:-2])
+    return result
+
+
+def split_blocks(lengths, n_blocks):
+    """
+    Splits trials of the given lengths into about n_blocks blocks of consecutive samples
+    in all. Returns a list of (trial, start, end) with start and end relative to the trial.
+    """
+    size = max(1, -(-int(np.sum(lengths)) // n_blocks))
+    return [(i, a, min(a + size, T)) for i, T in enumerate(lengths) for a in range(0, T, size)]
+
+
+@contextmanager
+def _shared(X):
+    """
+    Provides the path of an observations file whose series starts with the samples of X,
+    for worker processes to map (see _samples). That is the file X is mapped from if X is
+    a whole series from obsfile.load(), and a temporary copy otherwise.
+    """
+    path = getattr(X, 'filename', None)
+    if (isinstance(X, np.memmap) and path and X.offset == obsfile.HEADER_SIZE and
+            X.flags.c_contiguous and obsfile.is_obsfile(path) and
+            X.size == obsfile.read_header(path)['n_samples']):
+        yield path
+        return
+    X = np.asarray(X).ravel()
+    with obsfile.shared(X, [X.size]) as path:
+        yield path
+
+
+def _samples(block):
+    """ Samples of a (path, start, end) block from CategoricalHMM._blocks. """
+    path, a, b = block
+    return obsfile.load(path)[0][a:b]
+
+
+def _block_transfer(block, first, transmat, emissionprob, maxplus=False):
+    """ transfer() over a block, leaving out the first sample of a trial. """
+    X = _samples(block)
+    return transfer(X[1:] if first else X, transmat, emissionprob, maxplus)
+
+
+def _block_estep(block, before, after, startprob, transmat, emissionprob):
+    """
+    Statistics (as from CategoricalHMM._do_estep) of the samples of a block of a trial
+    given the normalised forward variables before the block (None if it starts the trial)
+    and the backward variables after its last sample, up to a constant.
+    """
+    X = _samples(block)
+    framelik = np.moveaxis(emissionprob, -1, 0)[np.asarray(X)][:, :, None]
+    start = startprob if before is None else np.matmul(before[:, None], transmat)[:, 0]
+    alpha, scale = forward(framelik, start[:, None], transmat)
+    last = after[:, None] / (alpha[-1] * after[:, None]).sum(axis=-1, keepdims=True)
+    beta = backward(framelik, transmat, scale, last=last)
+    gamma = alpha * beta
+    R, K, M = emissionprob.shape
+    stats = {'start': np.zeros((R, K)), 'trans': np.zeros((R, K, K)), 'obs': np.zeros((R, K, M))}
+    w = beta * framelik / np.where(scale == 0, 1, scale)[..., None]
+    if before is None:
+        stats['start'] += gamma[0, :, 0]
+    else:
+        stats['trans'] += transmat * before[:, :, None] * w[0, :, 0, None, :]
+    for r in range(R):
+        stats['trans'][r] += transmat[r] * np.tensordot(alpha[:-1, r], w[1:, r], axes=([0, 1], [0, 1]))
+    for o in np.unique(X):
+        stats['obs'][..., o] += gamma[X == o].sum(axis=0)[:, 0]
+    return stats
+
+
+def _block_viterbi(block, before, startprob, transmat, emissionprob):
+    """
+    Viterbi over the samples of a block of a trial given the log-probabilities of the best
+    paths ending in each state before the block (None if it starts the trial), up to a
+    constant.
+
+    Returns
+    -------
+    entry: best state before the block for each state of its first sample (None if first)
+    paths: (len(X), K) best paths through the block ending in each state
+    """
+    X = _samples(block)
+    with np.errstate(divide='ignore'):
+        logA, framelogprob = np.log(transmat), np.log(emissionprob.T)[np.asarray(X)]
+        delta = np.log(startprob) + framelogprob[0]
+    K = len(startprob)
+    entry = None
+    if before is not None:
+        s = before[:, None] + logA
+        entry, delta = s.argmax(axis=0), s.max(axis=0) + framelogprob[0]
+    psi = np.empty((len(X), K), dtype=np.min_scalar_type(K))
+    step = _viterbi_step(transmat)
+    for t in range(1, len(X)):
+        psi[t], delta = step(delta)
+        delta += framelogprob[t]
+    paths = np.empty((len(X), K), dtype=psi.dtype)
+    paths[-1] = np.arange(K)
+    for t in range(len(X) - 1, 0, -1):
+        paths[t - 1] = psi[t, paths[t]]
+    return entry, paths
+
+
+def _sum_stats(stats):
+    """ Sums sufficient statistics (dicts of arrays) over an iterable. """
+    total = None
+    for s in stats:
+        if total is None:
+            total = s
+        else:
+            for key in total:
+                total[key] += s[key]
+    return total
+
+
+@contextmanager
+def _mapper(jobs, threads=False):
+    """
+    Provides a map function running on a pool of jobs processes (threads if threads), or
+    the builtin one.
+    """
+    if jobs > 1:
+        with (ThreadPoolExecutor if threads else ProcessPoolExecutor)(max_workers=jobs) as ex:
+            yield ex.map
+    else:
+        yield map
+
+
+def _param_change(old, new):
+    """ Largest absolute change of any parameter of each of the stacked models. """
+    return np.max([np.abs(n - o).reshape((len(o), -1)).max(axis=1) for o, n in zip(old, new)],
+                  axis=0)
+
+
+class Monitor(object):
+    """
+    Keeps track of the log-likelihood along EM iterations. With the default policies, same
+    convergence criterion as hmmlearn's ConvergenceMonitor, but keeps the whole history,
+    and the time at which each iteration ended (only those run since start, when resuming
+    a fit). stopped tells which policy ended the fit.
+
+    Parameters
+    ----------
+    tol: converged once the log-likelihood improves by less than tol...
+    rtol: ... or less than rtol times its absolute value...
+    patience: ... in that many iterations in a row
+    n_iter: maximum number of iterations
+    max_time: maximum number of seconds since start
+    param_tol: converged once no parameter changes by more than param_tol in an iteration
+    floor: abandon the fit once its log-likelihood is below floor and, at its current rate
+           of improvement, would need more than horizon iterations to reach it, in
+           floor_patience iterations in a row (and at least patience): the first iterations,
+           and plateaus, are not held against it
+    """
+
+    def __init__(self, tol, n_iter, verbose=False, rtol=0., patience=1, max_time=None,
+                 param_tol=None, floor=None, horizon=100, floor_patience=10):
+        self.tol = tol
+        self.n_iter = n_iter
+        self.verbose = verbose
+        self.rtol = rtol
+        self.patience = patience
+        self.max_time = max_time
+        self.param_tol = param_tol
+        self.floor = floor
+        self.horizon = horizon
+        self.floor_patience = floor_patience
+        self.history = []
+        self.changes = []
+        self.iter = 0
+        self.start = time.time()
+        self.times = []
+        self._stopped = None
+
+    def report(self, logprob, change=None):
+        """ Records the log-likelihood of an iteration, and the largest parameter change. """
+        if self.verbose:
+            delta = logprob - self.history[-1] if self.history else np.nan
+            print('{:>10d} {:>16.4f} {:>+16.4f}'.format(self.iter + 1, logprob, delta),
+                  file=sys.stderr)
+        self.history.append(logprob)
+        if change is not None:
+            self.changes.append(float(change))
+        self.times.append(time.time())
+        self.iter += 1
+
+    @property
+    def stopped(self):
+        """ 'n_iter', 'tol', 'time', 'params' or 'abandoned' if the fit is over, else None. """
+        if self._stopped is not None:
+            return self._stopped
+        h = self.history
+        if self.iter == self.n_iter:
+            return 'n_iter'
+        if len(h) > self.patience and all(
+                h[i] - h[i - 1] < max(self.tol, self.rtol * abs(h[i]))
+                for i in range(len(h) - self.patience, len(h))):
+            return 'tol'
+        if self.max_time is not None and self.times and self.times[-1] - self.start >= self.max_time:
+            return 'time'
+        if self.param_tol is not None and self.changes and self.changes[-1] < self.param_tol:
+            return 'params'
+        n = max(self.patience, self.floor_patience)
+        if self.floor is not None and len(h) > n and all(
+                h[i] < self.floor and (h[i] - h[i - 1]) * self.horizon < self.floor - h[i]
+                for i in range(len(h) - n, len(h))):
+            return 'abandoned'
+        return None
+
+    @stopped.setter
+    def stopped(self, value):
+        """ Sets the outcome of a fit restored from elsewhere (see cache.ModelCache). """
+        self._stopped = value
+
+    @property
+    def converged(self):
+        return self.stopped is not None
+
+
+class CategoricalHMM(object):
+    """
+    HMM with categorical emissions, trained with batched Baum-Welch.
+
+    Parameters and fitted attributes follow hmmlearn.hmm.MultinomialHMM:
+    n_components, n_features, n_iter, tol, verbose, random_state, params and
+    init_params; startprob_, transmat_, emissionprob_ and monitor_. With the same
+    random state both produce the same initialisation, hence the same fits up to
+    rounding.
+
+    With n_restarts > 1, as many random initialisations are fitted together, stacked
+    along a first axis of all parameter arrays. A restart is dropped as soon as its
+    log-likelihood lags more than `prune` behind the best one and, at its current rate
+    of improvement, it would need more than PRUNE_HORIZON iterations to catch up. The
+    best restart is kept; restart_logprob_ and restart_iter_ record how all of them ended.
+
+    If checkpoint is a file name, the state of EM is saved there every checkpoint_every
+    iterations, and a later fit() with the same file resumes from it instead of starting
+    anew. The file is removed once the fit is done.
+
+    For many states, the transitions can be kept sparse: after every M-step, only the
+    n_transitions most likely transitions out of each state are kept, as well as those
+    above trans_threshold (see prune_transitions). Once sparse enough, the recursions
+    only go through the remaining transitions (see SparseTransmat).
+
+    With time_blocks, trials are split into that many blocks of time in all, which fit(),
+    score() and decode() process in parallel on as many processes: the forward and
+    Viterbi variables at the block boundaries follow from a (parallel) product of the
+    transition matrices of each block, see transfer(). Meant for few, long trials.
+    Processes only receive the bounds of their blocks, and map the samples from the
+    observations file X comes from (or from a temporary copy of X). The pool is created
+    by the first call and kept for the following ones, until close().
+
+    With n_threads > 1, fit() splits the trials of each E-step between as many threads
+    (see split_batches), and sums the statistics of all threads before the M-step.
+
+    Besides n_iter and tol, rtol, patience, max_time, param_tol and floor set when EM stops,
+    see Monitor. With floor, e.g. the log-likelihood of a fit with fewer states, a fit
+    which cannot catch up with it for PRUNE_PATIENCE iterations in a row is abandoned.
+    """
+
+    PRUNE_HORIZON = 100
+    PRUNE_PATIENCE = 10
+
+    def __init__(self, n_components=1, n_iter=10, tol=1e-2, verbose=False,
+                 random_state=None, params='ste', init_params='ste', n_restarts=1, prune=10.,
+                 checkpoint=None, checkpoint_every=100, n_transitions=None, trans_threshold=0.,
+                 time_blocks=None, n_threads=1, rtol=0., patience=1, max_time=None,
+                 param_tol=None, floor=None):
+        self.n_components = n_components
+        self.n_iter = n_iter
+        self.tol = tol
+        self.verbose = verbose
+        self.random_state = random_state
+        self.params = params
+        self.init_params = init_params
+        self.n_restarts = n_restarts
+        self.prune = prune
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.n_transitions = n_transitions
+        self.trans_threshold = trans_threshold
+        self.time_blocks = time_blocks
+        self.n_threads = n_threads
+        self.rtol = rtol
+        self.patience = patience
+        self.max_time = max_time
+        self.param_tol = param_tol
+        self.floor = floor
+        self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None  # Not picklable, and only valid in this process
+        return state
+
+    def _map(self):
+        """ Map function for the blocks of the time_blocks mode, on a pool kept until close(). """
+        if self.time_blocks <= 1:
+            return map
+        if getattr(self, '_pool', None) is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.time_blocks)
+        return self._pool.map
+
+    def close(self):
+        """ Shuts down the processes of the time_blocks mode, if any. """
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _monitor(self, verbose=False):
+        return Monitor(self.tol, self.n_iter, verbose, rtol=self.rtol, patience=self.patience,
+                       max_time=self.max_time, param_tol=self.param_tol, floor=self.floor,
+                       horizon=self.PRUNE_HORIZON, floor_patience=self.PRUNE_PATIENCE)
+
+    def _init(self, batches):
+        """ Returns initial startprob, transmat and emissionprob stacked for all restarts. """
+        K, R = self.n_components, self.n_restarts
+        if not hasattr(self, 'n_features'):
+            self.n_features = int(max(b.max() for _, b in batches)) + 1
+        if 's' in self.init_params or not hasattr(self, 'startprob_'):
+            startprob = np.full((R, K), 1. / K)
+        else:
+            startprob = np.tile(self.startprob_, (R, 1))
+        if 't' in self.init_params or not hasattr(self, 'transmat_'):
+            transmat = np.full((R, K, K), 1. / K)
+        else:
+            transmat = np.tile(self.transmat_, (R, 1, 1))
+        if 'e' in self.init_params or not hasattr(self, 'emissionprob_'):
+            rs = check_random_state(self.random_state)
+            emissionprob = normalize(rs.rand(R, K, self.n_features), axis=-1)
+        else:
+            emissionprob = np.tile(self.emissionprob_, (R, 1, 1))
+        return startprob, transmat, emissionprob
+
+    def _do_estep(self, batches, startprob, transmat, emissionprob, columns=None):
+        """
+        Returns the log-likelihood and sufficient statistics for each of the stacked models.
+        columns: optional (cols, used) for each batch, from _fold_columns: each model then
+                 only runs through the columns cols of the batch, of which the first
+                 used.sum() add to its statistics (see fit_folds)
+        """
+        R, K, M = emissionprob.shape
+        stats = {'start': np.zeros((R, K)), 'trans': np.zeros((R, K, K)),
+                 'obs': np.zeros((R, K, M))}
+        logprob = np.zeros(R)
+        B = emissionprob.transpose(0, 2, 1)
+        A = as_transitions(transmat)
+        for b, (_, X) in enumerate(batches):
+            if columns is None:
+                framelik = np.ascontiguousarray(B[:, X].transpose(1, 0, 2, 3))
+                n_used = [None] * R
+            else:
+                cols, used = columns[b]
+                X = X[:, cols]  # (T, models, width)
+                framelik = B[np.arange(R)[:, None], X]
+                n_used = used.sum(axis=1)
+            alpha, scale = forward(framelik, startprob[:, None], A)
+            beta = backward(framelik, A, scale)
+            with np.errstate(divide='ignore'):
+                ll = np.log(scale).sum(axis=0)
+            gamma = alpha * beta
+            if X.shape[0] > 1:
+                w = beta[1:]
+                w *= framelik[1:]
+                w /= np.where(scale[1:] == 0, 1, scale[1:])[..., None]
+            for r, n in enumerate(n_used):
+                logprob[r] += ll[r, :n].sum()
+                stats['start'][r] += gamma[0, r, :n].sum(axis=0)
+                if X.shape[0] > 1:
+                    stats['trans'][r] += transmat[r] * np.tensordot(
+                        alpha[:-1, r, :n], w[:, r, :n], axes=([0, 1], [0, 1]))
+                x = (X[:, r, :n] if columns is not None else X).ravel()
+                for k in range(K):
+                    stats['obs'][r, k] += np.bincount(x, weights=gamma[:, r, :n, k].ravel(),
+                                                      minlength=M)
+        return logprob, stats
+
+    def _do_estep_runs(self, runs, startprob, transmat, emissionprob):
+        """
+        Same as _do_estep(), for runs as returned by as_runs(). Runs are taken through in
+        one step each, with powers of the transition matrix (see RunPowers), so the cost
+        grows with the number of runs instead of the number of samples.
+        """
+        values, run_lengths, trials = runs
+        R, K, M = emissionprob.shape
+        stats = {'start': np.zeros((R, K)), 'trans': np.zeros((R, K, K)),
+                 'obs': np.zeros((R, K, M))}
+        logprob = np.zeros(R)
+        first = np.ones(values.size, dtype=bool)
+        first[1:] = trials[1:] != trials[:-1]
+        for r in range(R):
+            powers = RunPowers(transmat[r], emissionprob[r], sums=True)
+            u, ll, index, steps = forward_runs(values, run_lengths, trials, startprob[r],
+                                               emissionprob[r], powers)
+            logprob[r] = ll.sum()
+            P = np.array([powers.get(o, L)[0] for o, L in zip(values, steps)])
+            v = np.ones(u.shape)
+            for p in range(index.shape[1] - 1, -1, -1):
+                act, = np.nonzero(index[:, p] >= 0)
+                w = np.einsum('nkl,nl->nk', P[index[act, p]], v[act, p + 1])
+                c = w.sum(axis=1)
+                v[act, p] = w / np.where(c == 0, 1, c)[:, None]
+            gamma = normalize(u[:, 0] * v[:, 0], axis=1)
+            stats['start'][r] += gamma.sum(axis=0)
+            for o, g in zip(values[first], gamma):
+                stats['obs'][r, :, o] += g
+            # Transitions within runs, from the sum over (o, L) of the u v' / likelihood of its runs
+            n, p = np.nonzero(index >= 0)
+            U, V = u[n, p], v[n, p + 1]
+            Z = np.einsum('nk,nkl,nl->n', U, P, V)
+            keys, inverse = np.unique(values * (steps.max() + 1) + steps, return_inverse=True)
+            C = np.zeros((keys.size, K, K))
+            np.add.at(C, inverse, U[:, :, None] * V[:, None, :] / np.where(Z == 0, np.inf, Z)[:, None, None])
+            for key, c in zip(keys, C):
+                o, L = divmod(key, steps.max() + 1)
+                if L == 0:
+                    continue
+                xi = transmat[r] * emissionprob[r, :, o] * np.tensordot(c, powers.get(o, L)[1])
+                stats['trans'][r] += xi
+                stats['obs'][r, :, o] += xi.sum(axis=0)
+        return logprob, stats
+
+    def _blocks(self, X, lengths, path):
+        """
+        Splits the trials in X into (first symbol, first, (path, start, end)) blocks for the
+        time_blocks mode, path being an observations file holding X (see _shared).
+        """
+        X = np.asarray(X).ravel()
+        offsets = np.concatenate(([0], np.cumsum([X.size] if lengths is None else lengths)))
+        return [(X[offsets[i] + a], a == 0, (path, offsets[i] + a, offsets[i] + b))
+                for i, a, b in split_blocks(np.diff(offsets), self.time_blocks)]
+
+    def _forward_blocks(self, blocks, map, startprob, transmat, emissionprob):
+        """
+        Forward variables and log-likelihoods at the block boundaries, from the transfer
+        matrices of all blocks computed in parallel. Returns logprob (models,), the forward
+        variables before each block (None if it starts a trial) and the transfer matrices.
+        """
+        symbols, firsts, handles = zip(*blocks)
+        n = len(blocks)
+        transfers = list(map(_block_transfer, handles, firsts, [transmat] * n, [emissionprob] * n))
+        logprob = np.zeros(len(startprob))
+        before = []
+        with np.errstate(divide='ignore'):
+            for x, first, (F, logscale) in zip(symbols, firsts, transfers):
+                if first:
+                    a = startprob * emissionprob[..., x]
+                    c = a.sum(axis=-1)
+                    a /= np.where(c == 0, 1, c)[:, None]
+                    logprob += np.log(c)
+                before.append(None if first else a)
+                a = np.matmul(a[:, None], F)[:, 0]
+                c = a.sum(axis=-1)
+                a /= np.where(c == 0, 1, c)[:, None]
+                logprob += np.log(c) + logscale
+        return logprob, before, transfers
+
+    def _do_estep_blocks(self, blocks, map, startprob, transmat, emissionprob):
+        """
+        Same as _do_estep(), splitting trials into blocks of time processed in parallel by
+        map: transfer matrices of every block, forward and backward variables at the block
+        boundaries, then the statistics of every block given those.
+        """
+        logprob, before, transfers = self._forward_blocks(blocks, map, startprob, transmat,
+                                                          emissionprob)
+        n = len(blocks)
+        after = [None] * n
+        for i in range(n - 1, -1, -1):
+            if i + 1 == n or blocks[i + 1][1]:
+                d = np.ones(startprob.shape)
+            after[i] = d
+            d = np.matmul(transfers[i][0], d[..., None])[..., 0]
+            d /= np.where(d.sum(axis=-1) == 0, 1, d.sum(axis=-1))[:, None]
+        stats = _sum_stats(map(_block_estep, [h for _, _, h in blocks], before, after,
+                               [startprob] * n, [transmat] * n, [emissionprob] * n))
+        return logprob, stats
+
+    def _do_estep_threads(self, shards, map, *params, **kwargs):
+        """
+        Same as _do_estep(), on shards of the batches (see split_batches) in parallel
+        threads of map, the statistics of all shards being summed afterwards. numpy
+        releases the GIL within the array operations of the recursions, but only those
+        over large (trials, K) arrays per time step outweigh the interpreter overhead.
+        columns: optional columns (see _do_estep) of the batches of each shard
+        """
+        columns = kwargs.get('columns') or [None] * len(shards)
+        results = list(map(lambda shard, cols: self._do_estep(shard, *params, columns=cols),
+                           shards, columns))
+        return sum(lp for lp, _ in results), _sum_stats(s for _, s in results)
+
+    def _decode_blocks(self, X, lengths):
+        """ decode() in the time_blocks mode, with Viterbi in parallel over blocks. """
+        with np.errstate(divide='ignore'):
+            logA, logB = np.log(self.transmat_), np.log(self.emissionprob_)
+            logpi = np.log(self.startprob_)
+        logprob = 0
+        map = self._map()
+        with _shared(X) as path:
+            symbols, firsts, handles = zip(*self._blocks(X, lengths, path))
+            n = len(handles)
+            before, ends = [], []
+            for x, first, (F, logscale) in zip(symbols, firsts, map(_block_transfer, handles,
+                                                                    firsts, [logA] * n,
+                                                                    [logB] * n, [True] * n)):
+                if first:
+                    d = logpi + logB[:, x]
+                before.append(None if first else d)
+                d = (d[:, None] + F).max(axis=0)
+                shift = d.max() if np.isfinite(d.max()) else 0
+                d -= shift
+                logprob += shift + logscale
+                ends.append(d)
+            results = list(map(_block_viterbi, handles, before, [self.startprob_] * n,
+                               [self.transmat_] * n, [self.emissionprob_] * n))
+        states = []
+        for i in range(n - 1, -1, -1):
+            if i + 1 == n or firsts[i + 1]:
+                e = ends[i].argmax()
+                logprob += ends[i].max()
+            entry, paths = results[i]
+            states.append(paths[:, e])
+            if entry is not None:
+                e = entry[paths[0, e]]
+        return logprob, np.concatenate(states[::-1]).astype(int)
+
+    def _do_mstep(self, stats, startprob, transmat, emissionprob):
+        if 's' in self.params:
+            startprob = normalize(np.where(startprob == 0, 0, stats['start']), axis=-1)
+        if 't' in self.params:
+            transmat = normalize(np.where(transmat == 0, 0, stats['trans']), axis=-1)
+            if self.n_transitions is not None or self.trans_threshold:
+                transmat = prune_transitions(transmat, self.n_transitions, self.trans_threshold)
+        if 'e' in self.params:
+            emissionprob = normalize(stats['obs'], axis=-1)
+        return startprob, transmat, emissionprob
+
+    def _save_checkpoint(self, params, active, monitors, best, best_logprob):
+        history = np.full((len(monitors), max(m.iter for m in monitors)), np.nan)
+        for r, m in enumerate(monitors):
+            history[r, :m.iter] = m.history
+        data = dict(startprob=params[0], transmat=params[1], emissionprob=params[2],
+                    active=active, history=history, iter=[m.iter for m in monitors],
+                    best_logprob=best_logprob)
+        if best is not None:
+            data.update(best_startprob=best[0], best_transmat=best[1], best_emissionprob=best[2])
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.checkpoint)),
+                                   suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **data)
+        os.rename(tmp, self.checkpoint)
+
+    def _load_checkpoint(self, monitors):
+        """ Restores monitors and returns params, active, best and best_logprob. """
+        with np.load(self.checkpoint) as f:
+            for m, history, n in zip(monitors, f['history'], f['iter']):
+                m.history, m.iter = list(history[:n]), int(n)
+            best = None
+            if 'best_startprob' in f:
+                best = [f['best_startprob'], f['best_transmat'], f['best_emissionprob']]
+            return ([f['startprob'], f['transmat'], f['emissionprob']], f['active'], best,
+                    float(f['best_logprob']))
+
+    def fit(self, X, lengths=None):
+        if self.time_blocks:
+            with _shared(X) as path:
+                return self._fit(partial(self._do_estep_blocks, self._blocks(X, lengths, path),
+                                         self._map()),
+                                 self._init([(None, np.asarray(X))]))
+        batches = as_batches(X, lengths)
+        if self.n_threads > 1:
+            with _mapper(self.n_threads, threads=True) as map:
+                return self._fit(partial(self._do_estep_threads,
+                                         split_batches(batches, self.n_threads), map),
+                                 self._init(batches))
+        return self._fit(partial(self._do_estep, batches), self._init(batches))
+
+    def fit_runs(self, runs, lengths=None):
+        """
+        Fits run-length encoded trials, e.g. fit_runs(alv.intv.rle(X), lengths) instead of
+        fit(X, lengths), with the same result. Worth it when runs are long compared to
+        n_components², see _do_estep_runs().
+        """
+        runs = as_runs(runs, lengths)
+        return self._fit(partial(self._do_estep_runs, runs), self._init([(None, runs[0])]))
+
+    def _fit(self, estep, params):
+        """ EM from the stacked initial params, with estep(*params) giving the statistics. """
+        R = self.n_restarts
+        monitors = [self._monitor(self.verbose and R == 1) for _ in range(R)]
+        active = np.arange(R)
+        best, best_logprob = None, -np.inf
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            params, active, best, best_logprob = self._load_checkpoint(monitors)
+            if self.verbose:
+                print('Resuming from checkpoint at iteration {}'.format(monitors[active[0]].iter))
+        while active.size:
+            logprob, stats = estep(*params)
+            old, params = params, self._do_mstep(stats, *params)
+            changes = [None] * active.size
+            if self.param_tol is not None:
+                changes = _param_change(old, params)
+            for r, lp, change in zip(active, logprob, changes):
+                monitors[r].report(lp, change)
+            lead = max(logprob.max(), best_logprob)
+            keep = np.ones(active.size, dtype=bool)
+            for i, r in enumerate(active):
+                h, gap = monitors[r].history, lead - logprob[i]
+                if monitors[r].converged:
+                    keep[i] = False
+                    if logprob[i] > best_logprob:
+                        best, best_logprob = [p[i] for p in params], logprob[i]
+                elif (len(h) > 1 and gap > self.prune and
+                      (h[-1] - h[-2]) * self.PRUNE_HORIZON < gap):
+                    keep[i] = False
+                    if self.verbose:
+                        print('Dropped restart {} at iteration {}: log-likelihood {} vs. {}'
+                              .format(r, monitors[r].iter, logprob[i], lead))
+            if not keep.all():
+                active = active[keep]
+                params = [p[keep] for p in params]
+            if (self.checkpoint is not None and active.size and
+                    monitors[active[0]].iter % self.checkpoint_every == 0):
+                self._save_checkpoint(params, active, monitors, best, best_logprob)
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        self.startprob_, self.transmat_, self.emissionprob_ = best
+        self.restart_logprob_ = np.array([m.history[-1] for m in monitors])
+        self.restart_iter_ = np.array([m.iter for m in monitors])
+        self.monitor_ = monitors[int(np.argmax(self.restart_logprob_))]
+        return self
+
+    def score(self, X, lengths=None):
+        """ Log-likelihood of X under the model. """
+        if self.time_blocks:
+            with _shared(X) as path:
+                return self._forward_blocks(self._blocks(X, lengths, path), self._map(),
+                                            self.startprob_[None], self.transmat_[None],
+                                            self.emissionprob_[None])[0][0]
+        logprob = 0
+        A = as_transitions(self.transmat_)
+        for _, block in as_batches(X, lengths):
+            _, scale = forward(self.emissionprob_.T[block], self.startprob_, A)
+            with np.errstate(divide='ignore'):
+                logprob += np.log(scale).sum()
+        return logprob
+
+    def score_runs(self, runs, lengths=None):
+        """ Log-likelihood of run-length encoded trials, see fit_runs(). """
+        values, run_lengths, trials = as_runs(runs, lengths)
+        powers = RunPowers(self.transmat_, self.emissionprob_)
+        return forward_runs(values, run_lengths, trials, self.startprob_, self.emissionprob_,
+                            powers)[1].sum()
+
+    def decode(self, X, lengths=None):
+        """ Returns the log-probability of the Viterbi paths and the concatenated paths. """
+        if self.time_blocks:
+            return self._decode_blocks(X, lengths)
+        X = np.asarray(X).ravel()
+        lengths = [X.size] if lengths is None else np.asarray(lengths, dtype=int)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        states = np.empty(X.size, dtype=int)
+        with np.errstate(divide='ignore'):
+            logB = np.log(self.emissionprob_).T
+        logprob = 0
+        A = as_transitions(self.transmat_)
+        for idx, block in as_batches(X, lengths):
+            path, lp = viterbi(logB[block], self.startprob_, A)
+            logprob += lp.sum()
+            for col, i in enumerate(idx):
+                states[offsets[i]:offsets[i + 1]] = path[:, col]
+        return logprob, states
+
+    def predict(self, X, lengths=None):
+        return self.decode(X, lengths)[1]
+
+    def predict_proba(self, X, lengths=None):
+        """ Returns the posterior probabilities of each state for every sample. """
+        X = np.asarray(X).ravel()
+        lengths = [X.size] if lengths is None else np.asarray(lengths, dtype=int)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        posteriors = np.empty((X.size, self.n_components))
+        A = as_transitions(self.transmat_)
+        for idx, block in as_batches(X, lengths):
+            framelik = self.emissionprob_.T[block]
+            alpha, scale = forward(framelik, self.startprob_, A)
+            gamma = alpha * backward(framelik, A, scale)
+            for col, i in enumerate(idx):
+                posteriors[offsets[i]:offsets[i + 1]] = gamma[:, col]
+        return posteriors
+
+
+def _fold_columns(idx, folds, ids):
+    """
+    Columns of a batch of trials idx (see as_batches) which the model of each fold in ids
+    is trained on, as (folds, width) arrays of columns and of whether each is used: the
+    models are stacked, so folds with fewer columns are padded with unused ones.
+    """
+    train = folds[idx] != ids[:, None]
+    width = max(int(train.sum(axis=1).max()), 1)
+    cols = np.argsort(~train, axis=1, kind='mergesort')[:, :width]
+    return cols, np.take_along_axis(train, cols, axis=1)
+
+
+def fit_folds(X, lengths, folds, n_components, n_iter=10, tol=1e-2, n_features=None,
+              random_state=None, init=None, checkpoint=None, checkpoint_every=100,
+              n_transitions=None, trans_threshold=0., n_threads=1, **stopping):
+    """
+    Fits one model per cross-validation fold, all of them in lockstep.
+
+    Each EM iteration makes a single pass over all trials with the models of every fold
+    stacked (as for restarts in CategoricalHMM), each of them only running through the
+    trials it is trained on (see _fold_columns). Models which converge are taken out of
+    the stack.
+
+    Parameters
+    ----------
+    X, lengths: all trials, as for CategoricalHMM.fit
+    folds: fold of each trial. The model for fold f is trained on all other trials
+    n_components, n_iter, tol, n_features, random_state: as for CategoricalHMM
+    init: (startprob, transmat, emissionprob) stacked for all folds to start from,
+          instead of a random initialisation
+    checkpoint, checkpoint_every, n_transitions, trans_threshold, n_threads: as for
+                                                                          CategoricalHMM
+    stopping: rtol, patience, max_time and param_tol, as for CategoricalHMM
+
+    Returns
+    -------
+    List with the fitted model of each fold, sorted by fold
+    """
+    batches = as_batches(X, lengths)
+    folds = np.asarray(folds)
+    ids = np.unique(folds)
+    model = CategoricalHMM(n_components, n_iter, tol, random_state=random_state, n_restarts=ids.size,
+                           checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                           n_transitions=n_transitions, trans_threshold=trans_threshold,
+                           **stopping)
+    if n_features is not None:
+        model.n_features = n_features
+    params = model._init(batches) if init is None else init
+    monitors = [model._monitor() for _ in ids]
+    done = [np.full_like(p, np.nan) for p in params]  # Parameters of converged folds
+    active = np.arange(ids.size)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        params, active, done, _ = model._load_checkpoint(monitors)
+    shards = split_batches(batches, n_threads)
+    columns = [[_fold_columns(idx, folds, ids) for idx, _ in shard] for shard in shards]
+    with _mapper(n_threads, threads=True) as map:
+        while active.size:
+            logprob, stats = model._do_estep_threads(
+                shards, map, *params,
+                columns=[[(c[active], v[active]) for c, v in shard] for shard in columns])
+            old, params = params, model._do_mstep(stats, *params)
+            changes = [None] * active.size
+            if model.param_tol is not None:
+                changes = _param_change(old, params)
+            keep = np.ones(active.size, dtype=bool)
+            for i, f in enumerate(active):
+                monitors[f].report(logprob[i], changes[i])
+                if monitors[f].converged:
+                    keep[i] = False
+                    for d, p in zip(done, params):
+                        d[f] = p[i]
+            active = active[keep]
+            params = [p[keep] for p in params]
+            if (checkpoint is not None and active.size and
+                    monitors[active[0]].iter % checkpoint_every == 0):
+                model._save_checkpoint(params, active, monitors, done, np.nan)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    models = []
+    for f, monitor in enumerate(monitors):
+        m = CategoricalHMM(n_components, n_iter, tol, random_state=random_state, init_params='')
+        m.n_features = model.n_features
+        m.startprob_, m.transmat_, m.emissionprob_ = [d[f] for d in done]
+        m.monitor_ = monitor
+        models.append(m)
+    return models
+
+
+def save_model(m, path):
+    """ Saves the parameters of a fitted model (also an hmmlearn one) with np.savez. """
+    np.savez(path, startprob=m.startprob_, transmat=m.transmat_, emissionprob=m.emissionprob_)
+
+
+def load_model(path):
+    """ Returns a CategoricalHMM with the parameters saved by save_model(). """
+    with np.load(path) as f:
+        m = CategoricalHMM(len(f['startprob']), init_params='')
+        m.startprob_, m.transmat_, m.emissionprob_ = f['startprob'], f['transmat'], f['emissionprob']
+    m.n_features = m.emissionprob_.shape[1]
+    return m
+
+
+def split_state(startprob, transmat, emissionprob, occupancy, noise=0.05, random_state=None):
+    """
+    Adds one state to a model by splitting the most occupied one in two, e.g. to start EM
+    for k+1 states from a fit with k.
+
+    The new state is appended last. Both halves share the initial probability and incoming
+    transitions of the original state and keep its outgoing ones. Their emissions are
+    mixed with a bit of random noise to break the symmetry, since EM would never tell
+    apart two identical states.
+
+    Parameters
+    ----------
+    startprob, transmat, emissionprob: parameters of the model
+    occupancy: expected number of samples in each state, e.g. predict_proba(X).sum(axis=0)
+    noise: weight of the random emission probabilities mixed into both halves
+    random_state
+
+    Returns
+    -------
+    startprob, transmat, emissionprob and occupancy of the new model
+    """
+    rs = check_random_state(random_state)
+    s, K = int(np.argmax(occupancy)), len(startprob)
+    idx = np.append(np.arange(K), s)
+    startprob, occupancy = startprob[idx], np.asarray(occupancy, dtype=float)[idx]
+    startprob[[s, K]] /= 2
+    occupancy[[s, K]] /= 2
+    transmat = transmat[idx][:, idx]
+    transmat[:, [s, K]] /= 2
+    emissionprob = emissionprob[idx]
+    emissionprob[[s, K]] = ((1 - noise) * emissionprob[[s, K]] +
+                            noise * normalize(rs.rand(2, emissionprob.shape[1]), axis=1))
+    return startprob, transmat, emissionprob, occupancy
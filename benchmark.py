@@ -0,0 +1,262 @@
+# coding=utf-8
+"""
+Benchmarks of startup, loading, fitting, decoding, scoring and cross-validation on
+synthetic data.
+
+The data is drawn from a random HMM with k sticky meta-states, so that runs are like
+those of real recordings, and the same seed always gives the same data and the same fits.
+Every stage is timed `repeat` times (the best time is kept, as the least perturbed by the
+rest of the system), and reported with its throughput in samples per second and the peak
+resident memory so far (of this process, and of the worker processes for cross-validation).
+The peak is cumulative: it never goes down, so a stage only shows in it if it needs more
+memory than all stages before it.
+Cross-validation is run once for each number of jobs, to show how it scales. Startup is
+the time to import main.py in a new interpreter, as every run (and every worker process,
+when they are spawned rather than forked) does, and records which heavy modules it loads.
+
+    python benchmark.py -o results.json [-T 2000] [-t 20] [-m 6] [-k 4] [-j 1,2,4]
+
+Results are saved as JSON and can be compared with those of an earlier run (e.g. before a
+change) with --compare, which prints the ratio of every timing.
+"""
+from __future__ import print_function, division
+import getopt
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time as t
+import numpy as np
+import baumwelch
+import main as metastates
+import obsfile
+import options
+import utils
+from journal import Journal
+
+# Modules only the code paths needing them should import
+HEAVY_MODULES = ('matplotlib', 'pandas', 'hmmlearn', 'sklearn', 'scipy')
+
+
+def synthetic(T=2000, trials=20, n_features=6, n_states=4, stay=0.98, random_state=0):
+    """
+    Samples trials of T symbols from a random HMM whose states last 1 / (1 - stay) samples
+    on average. Returns the concatenated series (int8, starting at 0) and the lengths.
+    """
+    rs = baumwelch.check_random_state(random_state)
+    transmat = np.full((n_states, n_states), (1 - stay) / max(n_states - 1, 1))
+    np.fill_diagonal(transmat, stay if n_states > 1 else 1)
+    emissionprob = baumwelch.normalize(rs.rand(n_states, n_features) ** 4, axis=1)
+    n = T * trials
+    states = np.empty(n, dtype=int)
+    states[::T] = rs.randint(n_states, size=trials)
+    u = rs.rand(n)
+    cum = transmat.cumsum(axis=1)
+    for i in range(n):
+        if i % T:
+            states[i] = min(np.searchsorted(cum[states[i - 1]], u[i]), n_states - 1)
+    cum = emissionprob.cumsum(axis=1)[states]
+    series = (rs.rand(n, 1) > cum).sum(axis=1).clip(max=n_features - 1)
+    return series.astype(np.int8), np.full(trials, T, dtype=int)
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident memory of this process (or of its largest finished child) in MB, since it
+    started: ru_maxrss is never reset between stages.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def timed(fn, repeat=3):
+    """ Returns the output of fn() and the best of repeat runs, in seconds. """
+    best = np.inf
+    for _ in range(repeat):
+        tick = t.time()
+        out = fn()
+        best = min(best, t.time() - tick)
+    return out, best
+
+
+def startup(statement, repeat=3):
+    """ Returns the best time of running statement in a new interpreter, in seconds. """
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.devnull, 'w') as null:
+        return timed(lambda: subprocess.check_call([sys.executable, '-c', statement], cwd=here,
+                                                   stderr=null), repeat)[1]
+
+
+def heavy_imports(statement):
+    """ Returns the heavy modules loaded by running statement in a new interpreter. """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = '{}; import sys; print(",".join(m for m in {!r} if m in sys.modules))'.format(
+        statement, HEAVY_MODULES)
+    with open(os.devnull, 'w') as null:
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=here, stderr=null)
+    return [m for m in out.decode('utf-8').strip().split(',') if m]
+
+
+def record(results, name, seconds, n_samples, **info):
+    r = dict(name=name, seconds=seconds,
+             samples_per_s=n_samples / seconds if seconds and n_samples else None,
+             cumulative_peak_rss_mb=peak_rss_mb(), **info)
+    results.append(r)
+    print('{:<24} {:>10.4f}s {:>14} samples/s {:>8.1f} MB peak so far'.format(
+        name, seconds, '{:.0f}'.format(r['samples_per_s']) if r['samples_per_s'] else '-',
+        r['cumulative_peak_rss_mb']))
+    return r
+
+
+def run(T=2000, trials=20, n_features=6, n_states=4, jobs=(1,), n_iter=10, nfold=5, repeat=3,
+        random_state=0, verbose=False):
+    """
+    Runs all benchmarks. Returns a dict with the configuration, the environment and the
+    list of results, one per stage.
+    """
+    config = dict(T=T, trials=trials, n_features=n_features, n_states=n_states, jobs=list(jobs),
+                  n_iter=n_iter, nfold=nfold, repeat=repeat, random_state=random_state)
+    env = dict(python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+               cpus=utils.available_cpu_count())
+    results = []
+    python = record(results, 'startup_python', startup('pass', repeat), None)['seconds']
+    seconds = startup('import main', repeat)
+    record(results, 'startup_import_main', seconds, None, imports_s=seconds - python,
+           heavy_modules=heavy_imports('import main'))
+    series, lengths = synthetic(T, trials, n_features, n_states, random_state=random_state)
+    n = series.size
+    tmp = tempfile.mkdtemp()
+    try:
+        text, binary = os.path.join(tmp, 'obs.txt'), os.path.join(tmp, 'obs.bin')
+        np.savetxt(text, series + 1, fmt='%d')
+        obsfile.write(binary, series, lengths)
+        record(results, 'load_text',
+               timed(lambda: metastates.load_observations(text), repeat)[1], n)
+        record(results, 'load_obsfile',
+               timed(lambda: np.asarray(metastates.load_observations(binary)).sum(), repeat)[1], n)
+
+        X = series.reshape((n, 1))
+        for engine in ('native', 'hmmlearn'):
+            def fit():
+                np.random.seed(random_state)
+                return metastates.infer(X, lengths, n_states, viterbi=False, n_iter=n_iter,
+                                        tol=-np.inf, engine=engine)[0][0]
+            m, seconds = timed(fit, repeat)
+            iters = m.monitor_.iter
+            record(results, 'em_iteration_' + engine, seconds / iters, n, iterations=iters)
+        native = metastates.infer(X, lengths, n_states, viterbi=False, n_iter=n_iter,
+                                  tol=-np.inf, engine='native')[0][0]
+        record(results, 'viterbi', timed(lambda: native.predict(X, lengths), repeat)[1], n)
+        record(results, 'score', timed(lambda: native.score(X, lengths), repeat)[1], n)
+
+        states = '2-{}'.format(n_states) if n_states > 2 else str(n_states)
+        base = None
+        for j in jobs:
+            output = os.path.join(tmp, 'cv{}'.format(j))
+            opts = options.parse(['-i', binary, '-o', output, '-s', states, '-c', str(nfold),
+                                  '-e', 'native', '-j', str(j), '--checkpoint-every', '0',
+                                  '--max-iter', str(n_iter), '--tol', '-inf'] +
+                                 (['-v'] if verbose else []))
+            opts.trials, opts.checkpoint = len(lengths), None
+            journal = Journal(output + '.journal')
+            np.random.seed(random_state)
+            tick = t.time()
+            metastates.cross_validate(series, lengths, opts, binary, journal)
+            seconds = t.time() - tick
+            folds = journal.records('fold')
+            schedule = journal.records('schedule')[-1]
+            offsets = obsfile.offsets(lengths)
+            trained = sum(n - offsets[f['end']] + offsets[f['start']] for f in folds)
+            r = record(results, 'crossval_jobs{}'.format(j), seconds, trained,
+                       jobs=j, fits=len(folds), iterations=sum(f['iter'] for f in folds),
+                       utilisation=schedule['utilisation'],
+                       workers_cumulative_peak_rss_mb=peak_rss_mb(True))
+            base = base or seconds
+            r['speedup'] = base / seconds  # Relative to the first number of jobs
+    finally:
+        shutil.rmtree(tmp)
+    return {'config': config, 'env': env, 'results': results}
+
+
+def compare(new, old):
+    """ Prints the ratio old / new of the time of every stage found in both runs. """
+    before = {r['name']: r for r in old['results']}
+    print('{:<24} {:>10} {:>10} {:>8}'.format('stage', 'before', 'after', 'speedup'))
+    for r in new['results']:
+        if r['name'] in before:
+            b = before[r['name']]['seconds']
+            print('{:<24} {:>9.4f}s {:>9.4f}s {:>7.2f}x'.format(r['name'], b, r['seconds'],
+                                                              b / r['seconds']))
+
+
+def main(argv):
+    usage_str = str(
+        "Usage: python benchmark.py -o <output-file>\n\nOther options:\n"
+        "    -h, --help           This help\n"
+        "    -o, --output-file    JSON file to save the results in\n"
+        "    -T, --samples        Samples per trial [default=2000]\n"
+        "    -t, --trials         Number of trials [default=20]\n"
+        "    -m, --symbols        Size of the alphabet [default=6]\n"
+        "    -k, --states         Number of states of the data and the fits [default=4]\n"
+        "                         (cross-validation fits 2 to k)\n"
+        "    -j, --jobs           Numbers of jobs to cross-validate with [default=1]\n"
+        "    -n, --iterations     EM iterations per fit [default=10]\n"
+        "    -c, --crossval       Number of folds [default=5]\n"
+        "    -r, --repeat         Runs of each timing, the best is kept [default=3]\n"
+        "        --seed           Random seed of the data [default=0]\n"
+        "        --compare        JSON file of an earlier run to compare with\n"
+        "    -v, --verbose        Display progress of cross-validation")
+    try:
+        vals, args = getopt.getopt(argv, 'ho:T:t:m:k:j:n:c:r:v',
+                                   ['help', 'output-file=', 'samples=', 'trials=', 'symbols=',
+                                    'states=', 'jobs=', 'iterations=', 'crossval=', 'repeat=',
+                                    'seed=', 'compare=', 'verbose'])
+    except getopt.GetoptError as error:
+        print('ERROR: ' + error.msg + '\n' + usage_str)
+        sys.exit(2)
+    kwargs, output_file, baseline = {}, None, None
+    for opt, arg in vals:
+        if opt in ('-h', '--help'):
+            print(usage_str)
+            sys.exit()
+        elif opt in ('-o', '--output-file'):
+            output_file = arg
+        elif opt in ('-T', '--samples'):
+            kwargs['T'] = int(arg)
+        elif opt in ('-t', '--trials'):
+            kwargs['trials'] = int(arg)
+        elif opt in ('-m', '--symbols'):
+            kwargs['n_features'] = int(arg)
+        elif opt in ('-k', '--states'):
+            kwargs['n_states'] = int(arg)
+        elif opt in ('-j', '--jobs'):
+            kwargs['jobs'] = utils.parse_ranges(arg)
+        elif opt in ('-n', '--iterations'):
+            kwargs['n_iter'] = int(arg)
+        elif opt in ('-c', '--crossval'):
+            kwargs['nfold'] = int(arg)
+        elif opt in ('-r', '--repeat'):
+            kwargs['repeat'] = int(arg)
+        elif opt == '--seed':
+            kwargs['random_state'] = int(arg)
+        elif opt == '--compare':
+            baseline = arg
+        elif opt in ('-v', '--verbose'):
+            kwargs['verbose'] = True
+    if not output_file:
+        print('ERROR: output file required\n' + usage_str)
+        sys.exit(1)
+    report = run(**kwargs)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline, 'r') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,115 @@
+# coding=utf-8
+"""
+On-disk cache of fitted models, addressed by a hash of the training data and of the
+fit hyperparameters.
+
+Each entry is an .npz file with the parameters of the model and its convergence info
+(log-likelihood history, number of iterations, stopping policy and which of its rules
+ended the fit). The cache is shared by all worker processes: entries are written
+atomically, and the least recently used ones are removed whenever the cache grows beyond
+its maximum size.
+
+Whether a fit was warm started is part of the hyperparameters (see main.infer), but the
+initial parameters themselves are not: any fit with the same data and hyperparameters is
+considered as good as any other.
+"""
+from __future__ import print_function, division
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import baumwelch
+
+
+class ModelCache(object):
+    """
+    Parameters
+    ----------
+    path: directory holding the cache, created if needed
+    max_bytes: maximum size of all entries
+    """
+
+    # Stopping policy of a baumwelch.Monitor, besides tol and n_iter
+    POLICY = ('rtol', 'patience', 'max_time', 'param_tol', 'floor', 'horizon',
+              'floor_patience')
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:  # Created meanwhile by another process
+                pass
+
+    @staticmethod
+    def key(series, lengths, **params):
+        """ Returns a hash of the data and hyperparameters (which must be JSON serialisable). """
+        series = np.ascontiguousarray(series)
+        h = hashlib.sha1(series.dtype.str.encode('utf-8'))
+        h.update(series)
+        h.update(np.ascontiguousarray(lengths, dtype='<i8'))
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """ Returns the cached model (a baumwelch.CategoricalHMM) for key, or None. """
+        try:
+            with np.load(self._file(key)) as f:
+                m = baumwelch.CategoricalHMM(len(f['startprob']), n_iter=int(f['n_iter']),
+                                             tol=float(f['tol']), init_params='')
+                m.startprob_, m.transmat_, m.emissionprob_ = f['startprob'], f['transmat'], \
+                    f['emissionprob']
+                m.monitor_ = baumwelch.Monitor(m.tol, m.n_iter, **json.loads(str(f['policy'])))
+                m.monitor_.history, m.monitor_.iter = list(f['history']), int(f['iter'])
+                m.monitor_.changes, m.monitor_.start = list(f['changes']), 0.
+                m.monitor_.times = list(f['times'])
+                m.monitor_.stopped = str(f['stopped']) or None
+            os.utime(self._file(key), None)  # Most recently used
+        except (IOError, OSError, KeyError):  # KeyError: entry from an older version
+            return None
+        m.n_features = m.emissionprob_.shape[1]
+        return m
+
+    def put(self, key, m):
+        """ Stores a fitted model (native or hmmlearn) under key. """
+        monitor = m.monitor_
+        if isinstance(monitor, baumwelch.Monitor):
+            policy = dict((name, getattr(monitor, name)) for name in self.POLICY)
+            changes, times = monitor.changes, np.subtract(monitor.times, monitor.start)
+            stopped = monitor.stopped
+        else:  # hmmlearn's ConvergenceMonitor: only n_iter and tol
+            policy, changes, times = {}, [], []
+            stopped = 'n_iter' if monitor.iter == monitor.n_iter else 'tol'
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, startprob=m.startprob_, transmat=m.transmat_, emissionprob=m.emissionprob_,
+                     history=list(monitor.history), iter=monitor.iter, n_iter=monitor.n_iter,
+                     tol=monitor.tol, policy=json.dumps(policy), changes=changes, times=times,
+                     stopped=stopped or '')
+        os.rename(tmp, self._file(key))
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_bytes. """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:  # Removed by another process
+                pass
+            total -= size
@@ -0,0 +1,145 @@
+# coding=utf-8
+"""
+Headless export of figures of fitted models: for every number of states and every trial,
+the ribbons of the Viterbi path and of the observations (see alv.hmm_viz.LodRibbon),
+saved as PNG or SVG with the Agg backend, without any display.
+
+Figures are rendered on a pool of processes, each drawing all of its figures on the same
+figure and axes. The digest of the inputs of every figure (model, trial, settings) is
+kept in a manifest in the output directory, and figures whose inputs have not changed
+since they were saved are not rendered again.
+"""
+from __future__ import print_function, division
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import baumwelch
+import obsfile
+
+MANIFEST = 'figures.json'
+VERSION = 1  # Bump to render all figures again after changing how they are drawn
+
+_figure = None  # (figure, axes) of this process, reused by all its figures
+_models = {}  # Models loaded by this process, by file
+
+
+def _axes(size, dpi):
+    """ Returns the figure and axes of this process, cleared. """
+    global _figure
+    if _figure is None or tuple(_figure[0].get_size_inches()) != tuple(size) or \
+            _figure[0].dpi != dpi:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=size, dpi=dpi)
+        FigureCanvasAgg(fig)
+        _figure = fig, fig.add_subplot(111)
+    fig, ax = _figure
+    ax.cla()
+    return fig, ax
+
+
+def _model(path):
+    if path not in _models:
+        _models[path] = baumwelch.load_model(path)
+    return _models[path]
+
+
+def render(path, trial, model_file, output_file, sr=250., size=(12, 3), dpi=100):
+    """
+    Decodes a trial of an observations file with a model and saves the ribbons of its
+    Viterbi path and observations (states and symbols starting at 1) to output_file, in
+    the format given by its extension.
+    """
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import alv.vizcol as col
+    from alv import hmm_viz as viz
+    series, header = obsfile.load(path)
+    bounds = obsfile.offsets(header['lengths'])
+    x = np.asarray(series[bounds[trial]:bounds[trial + 1]], dtype=int)
+    m = _model(model_file)
+    vpath = m.predict(x.reshape((-1, 1)))
+    fig, ax = _axes(size, dpi)
+    ribbons = [viz.LodRibbon(vpath + 1, sr, col.stdcolors(), y0=0, y_width=0.1999, ax=ax,
+                             legend_loc=1),
+               viz.LodRibbon(x + 1, sr, col.stdcolors(), y0=0.2, y_width=0.1999, ax=ax)]
+    ax.set_ylim(-0.15, 0.45)  # Room for the legend above the ribbons
+    ax.set_yticks([0, 0.2])
+    ax.set_yticklabels(['Viterbi path', 'Observations'])
+    ax.set_xlabel('Time (s)')
+    ax.set_title('n_states={}, trial {}'.format(m.n_components, trial))
+    fig.tight_layout()
+    fig.savefig(output_file)
+    for r in ribbons:
+        r.remove()
+    return output_file
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else json.dumps(part).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def export(path, fits, directory, fmt='png', jobs=1, sr=250., size=(12, 3), dpi=100,
+           verbose=False):
+    """
+    Renders a figure (see render) for every fit and every trial of the observations file
+    path to directory, as k<n_states>.trial<trial>.<fmt>, on jobs processes. Figures whose
+    inputs have not changed since they were saved are skipped.
+
+    Parameters
+    ----------
+    path: observations file
+    fits: list of (n_states, model file) pairs, as saved by main.py
+    fmt: png or svg
+
+    Returns the number of figures rendered and skipped.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest_file = os.path.join(directory, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    series, header = obsfile.load(path)
+    bounds = obsfile.offsets(header['lengths'])
+    trials = [_digest(np.ascontiguousarray(series[a:b]).tobytes())
+              for a, b in zip(bounds[:-1], bounds[1:])]
+    settings = [VERSION, sr, list(size), dpi]
+    todo = []
+    for k, model_file in fits:
+        # The parameters, not the file: the entries of np.savez archives carry timestamps
+        with np.load(model_file) as f:
+            model = _digest(*[np.ascontiguousarray(f[key]).tobytes()
+                              for key in ('startprob', 'transmat', 'emissionprob')])
+        for trial, data in enumerate(trials):
+            name = 'k{}.trial{}.{}'.format(k, trial, fmt)
+            digest = _digest(settings, model, data)
+            if manifest.get(name) != digest or not os.path.exists(os.path.join(directory, name)):
+                todo.append((name, digest, trial, model_file))
+    if verbose:
+        print('Rendering {} figures, {} unchanged'.format(len(todo), len(fits) * len(trials) -
+                                                          len(todo)))
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        futures = {ex.submit(render, path, trial, model_file, os.path.join(directory, name),
+                             sr, size, dpi): (name, digest)
+                   for name, digest, trial, model_file in todo}
+        for future in as_completed(futures):
+            future.result()
+            name, digest = futures[future]
+            manifest[name] = digest
+            _save_manifest(manifest_file, manifest)
+    return len(todo), len(fits) * len(trials) - len(todo)
@@ -0,0 +1,55 @@
+# coding=utf-8
+"""
+Append-only journal of completed work, so that an interrupted run can be resumed.
+
+Each record is a JSON object on its own line, flushed to disk before append() returns.
+A line cut short by a crash is ignored when reading back, together with anything after it.
+"""
+from __future__ import print_function, division
+import json
+import os
+
+
+class Journal(object):
+    """
+    Parameters
+    ----------
+    path: file holding the journal
+    resume: keep the records already in path, otherwise start a new journal
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._records = self._read() if resume else []
+        if not resume:
+            open(path, 'w').close()
+        else:  # Drop a truncated last line before appending to it
+            with open(path, 'w') as f:
+                for record in self._records:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def _read(self):
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+    def records(self, kind=None):
+        """ Returns the records in order, only those with the given 'kind' unless None. """
+        return [r for r in self._records if kind is None or r.get('kind') == kind]
+
+    def append(self, record):
+        """ Writes record (a JSON serialisable dict) durably. """
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._records.append(record)
@@ -1,26 +1,38 @@
 # coding=utf-8
 from __future__ import print_function
+import os
+import shutil
 import sys
 import time as t
-import hmmlearn.hmm as hmm
-import matplotlib.pyplot as pl
 import numpy as np
-import alv.vizcol as col
+from alv.intv import rle
+import baumwelch
+import obsfile
+from cache import ModelCache
+from journal import Journal
+from scheduler import CostModel, Scheduler
+import figures
 import options
-from alv import hmm_viz as viz
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import tracing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 
 def load_observations(input_file, shift=-1):
     """
     Loads a text file of integers (emissions of the HMM) into a numpy array.
+    Binary files written by obsfile.py are memory-mapped read-only instead.
 
     Parameters
     ----------
     input_file: duh!
     shift: If the integers in the file start at 1, use a shift of -1 (to conform to zero-indexed arrays)
+           Ignored for binary files, which are stored already shifted.
 
     """
+    if obsfile.is_obsfile(input_file):
+        series, _ = obsfile.load(input_file)
+        return series
     series = np.loadtxt(input_file, dtype=np.int8)
     series += shift
     return series
@@ -44,18 +56,61 @@ def save_viterbi(viterbi_path, output_file, shift=1):
     return
 
 
+def stream_decode(series, lengths, model, output_file, chunk_size=1 << 16, verbose=False):
+    """
+    Decodes every trial with a trained model and writes the Viterbi paths to an observations
+    file (see obsfile.py; states are stored zero-based) as they become final, so that only a
+    window of the paths is kept in memory (see baumwelch.stream_viterbi).
+
+    Parameters
+    ----------
+    series: emissions, e.g. the memory map returned by load_observations
+    lengths: lengths of individual trials
+    model: fitted model, e.g. from baumwelch.load_model()
+    output_file
+    chunk_size: number of samples read at a time
+    """
+    tick = t.time()
+    w = obsfile.Writer(output_file, np.min_scalar_type(model.n_components - 1), shift=-1)
+    offsets = obsfile.offsets(lengths)
+    for a, b in zip(offsets[:-1], offsets[1:]):
+        chunks = (series[i:min(i + chunk_size, b)] for i in range(a, b, chunk_size))
+        for segment in baumwelch.stream_viterbi(chunks, model.startprob_, model.transmat_,
+                                                model.emissionprob_):
+            w.append(segment)
+    w.close(lengths)
+    if verbose: print('Time for streaming viterbi: {}s'.format(t.time() - tick))
+
+
 def compute_lengths(series, num_trials):
     """
-    Computes the array of lengths of trials (size(series)/num_trials) for usage with hmmlearn.
-    Currently(?) trivial, since all trials are of the same length.
+    Computes the array of lengths of trials (size(series)/num_trials) for usage with hmmlearn,
+    for series made of trials of the same length. See load_lengths() otherwise.
     """
     trial_length = int(series.size / num_trials)
-    assert series.size % num_trials == 0, 'Length of time series is not a multiple of number of trials'
-    return trial_length * np.ones(num_trials)
+    if series.size % num_trials != 0:
+        raise ValueError('Length of time series is not a multiple of number of trials, '
+                         'use --lengths for trials of different lengths')
+    return trial_length * np.ones(num_trials, dtype=int)
+
+
+def load_lengths(lengths_file, series):
+    """
+    Loads the lengths of trials of different lengths from a text file of integers, one per
+    trial. Together with the series they form a packed ragged array: trial i spans
+    obsfile.offsets(lengths)[i] to obsfile.offsets(lengths)[i + 1].
+    """
+    lengths = np.loadtxt(lengths_file, dtype=int, ndmin=1)
+    if lengths.sum() != series.size:
+        raise ValueError('Lengths add up to {}, but there are {} samples'
+                         .format(lengths.sum(), series.size))
+    return lengths
 
 
 def infer(series, lengths, n_states=2, viterbi=True, verbose=False, start=0, end=0, n_iter=4000,
-          tol=1e-6):
+          tol=1e-6, engine='hmmlearn', n_restarts=1, init=None, cache=None, checkpoint=None,
+          checkpoint_every=100, n_transitions=None, trans_threshold=0., runs=False,
+          time_blocks=None, n_threads=1, stopping=None, floor=None):
     """
 
     Parameters
@@ -69,30 +124,380 @@ def infer(series, lengths, n_states=2, viterbi=True, verbose=False, start=0, end
     end: HACK
     n_iter
     tol
+    engine: 'hmmlearn' or 'native' (batched Baum-Welch in baumwelch.py)
+    n_restarts: number of random initialisations. The native engine fits them together
+                and drops those lagging behind, hmmlearn fits them one after another.
+    init: (startprob, transmat, emissionprob) to start from instead of a random
+          initialisation, in which case n_restarts is ignored.
+    cache: cache.ModelCache to look the model up in before fitting, and to store it in after.
+           Cached models are always baumwelch.CategoricalHMM.
+    checkpoint: directory to checkpoint the native engine in every checkpoint_every iterations,
+                so that an interrupted fit of the same data and hyperparameters resumes
+                where it stopped. hmmlearn fits are not checkpointed.
+    n_transitions, trans_threshold: keep transitions sparse with the native engine, see
+                                    baumwelch.CategoricalHMM
+    runs: fit the run-length encoded series with the native engine (same result, faster
+          when the series is made of long runs of the same symbol)
+    time_blocks: with the native engine, split the series into that many blocks of time,
+                 fitted and decoded in parallel on as many processes
+    n_threads: with the native engine, number of threads sharing the trials in each E-step
+    stopping: dict of further stopping policies of the native engine (rtol, patience,
+              max_time, param_tol), see baumwelch.Monitor
+    floor: with the native engine, abandon the fit if its log-likelihood cannot reach floor
+           (see baumwelch.Monitor). Abandoned fits are not cached.
 
     Returns
     -------
 
     """
     outputs = np.unique(series)
-    if verbose: print("Inferring parameters of MultinomialHMM for n_states={0}, "
-                      "max. iterations={1}, tolerance={2}".format(n_states, n_iter, tol))
-    m = hmm.MultinomialHMM(n_components=n_states, n_iter=n_iter, tol=tol, verbose=verbose,
-                           algorithm='viterbi')
-    m.n_features = outputs.size
-
+    if verbose: print("Inferring parameters of MultinomialHMM ({3}) for n_states={0}, "
+                      "max. iterations={1}, tolerance={2}".format(n_states, n_iter, tol, engine))
+    init_params = 'ste'
+    if init is not None:
+        init_params, n_restarts = '', 1
     tick = t.time()
-    m.fit(series, lengths)
-    if verbose: print('Time fitting: {}s'.format(t.time() - tick))
+    m = None
+    hyper = dict(n_states=n_states, n_iter=n_iter, tol=tol, engine=engine, n_restarts=n_restarts,
+                 warm=init is not None)
+    if n_transitions is not None or trans_threshold:
+        hyper.update(n_transitions=n_transitions, trans_threshold=trans_threshold)
+    hyper.update(stopping or {})
+    if cache is not None:
+        key = cache.key(series, lengths, **hyper)
+        m = cache.get(key)
+        if verbose and m is not None: print('Found model in cache: {}'.format(key))
+    cached = m is not None
+    if not cached and engine == 'native':
+        if checkpoint is not None:
+            checkpoint = os.path.join(checkpoint, ModelCache.key(series, lengths, **hyper) + '.npz')
+        m = baumwelch.CategoricalHMM(n_components=n_states, n_iter=n_iter, tol=tol, verbose=verbose,
+                                     n_restarts=n_restarts, init_params=init_params,
+                                     checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                                     n_transitions=n_transitions, trans_threshold=trans_threshold,
+                                     time_blocks=time_blocks, n_threads=n_threads, floor=floor,
+                                     **(stopping or {}))
+        m.n_features = outputs.size
+        if init is not None:
+            m.startprob_, m.transmat_, m.emissionprob_ = init
+        if runs:
+            m.fit_runs(rle(series.ravel()), lengths)
+        else:
+            m.fit(series, lengths)
+    elif not cached:
+        import hmmlearn.hmm as hmm  # Only loaded (with scikit-learn and scipy) if used
+        for _ in range(n_restarts):
+            r = hmm.MultinomialHMM(n_components=n_states, n_iter=n_iter, tol=tol, verbose=verbose,
+                                   algorithm='viterbi', init_params=init_params)
+            r.n_features = outputs.size
+            if init is not None:
+                r.startprob_, r.transmat_, r.emissionprob_ = init
+            r.fit(series, lengths)
+            if m is None or r.monitor_.history[-1] > m.monitor_.history[-1]:
+                m = r
+    if cache is not None and not cached and getattr(m.monitor_, 'stopped', None) != 'abandoned':
+        cache.put(key, m)
+    m.fit_time_ = t.time() - tick
+    tracing.emit('fit', seconds=m.fit_time_, k=n_states, engine=engine, iter=m.monitor_.iter,
+                 cached=cached)
+    if not cached:
+        tracing.iterations(m.monitor_, k=n_states)
+    if verbose: print('Time fitting: {}s'.format(m.fit_time_))
     tick = t.time()
     viterbi_path = []
     if viterbi:
         viterbi_path = m.predict(series.reshape((series.size, 1)), lengths=lengths)
+        tracing.emit('decode', seconds=t.time() - tick, k=n_states)
         if verbose: print('Time for viterbi: {}s'.format(t.time() - tick))
+    if isinstance(m, baumwelch.CategoricalHMM):
+        m.close()  # Processes of time_blocks, kept from fitting to decoding
 
     return [[m, start, end], viterbi_path]  # HACK HACK
 
 
+def fit_chain(trials, states, floors=None, **kwargs):
+    """
+    Runs infer() on an obsfile.Trials for each number of states in turn, for use in worker
+    processes: they only receive the handle and map the data themselves instead of
+    unpickling a copy.
+    Every fit after the first starts from the previous one, with its most occupied states
+    split until there are enough (see baumwelch.split_state). A chain of one is a plain fit.
+    floors: {k: log-likelihood} below which fits with k states are abandoned, see infer()
+
+    Returns
+    -------
+    List with the output of infer() for each number of states
+    """
+    with tracing.span('load'):
+        series, lengths = trials.load()
+    series = series[:, None]
+    results = []
+    for k in states:
+        init = None
+        if results:
+            m = results[-1][0][0]
+            startprob, transmat, emissionprob = m.startprob_, m.transmat_, m.emissionprob_
+            occupancy = m.predict_proba(series, lengths).sum(axis=0)
+            for _ in range(k - m.n_components):
+                startprob, transmat, emissionprob, occupancy = baumwelch.split_state(
+                    startprob, transmat, emissionprob, occupancy)
+            init = startprob, transmat, emissionprob
+        results.append(infer(series, lengths, k, init=init, floor=(floors or {}).get(k), **kwargs))
+    return results
+
+
+def fit_folds_chain(trials, states, bounds, n_iter=4000, tol=1e-6, verbose=False, cache=None,
+                    checkpoint=None, checkpoint_every=100, n_transitions=None, trans_threshold=0.,
+                    n_threads=1, stopping=None):
+    """
+    Like fit_chain(), but fits the models for all cross-validation folds of each number of
+    states together, in one pass over the data per iteration (see baumwelch.fit_folds).
+    Only for the native engine, and without restarts.
+
+    Parameters
+    ----------
+    trials: obsfile.Trials with all trials
+    states: chain of numbers of states
+    bounds: list of (start, end) ranges of trials held out in each fold
+    cache: cache.ModelCache, with the same keys as infer() on the training trials of a fold
+    checkpoint, checkpoint_every, n_transitions, trans_threshold, n_threads, stopping: as for
+                                                                                infer()
+
+    Returns
+    -------
+    List with output like that of infer(), without Viterbi paths, for every fold and state
+    """
+    series, lengths = trials.load()
+    folds = np.empty(len(lengths), dtype=int)
+    for f, (start, end) in enumerate(bounds):
+        folds[start:end] = f
+    n_features = np.unique(series).size
+    sparse = {}
+    if n_transitions is not None or trans_threshold:
+        sparse = dict(n_transitions=n_transitions, trans_threshold=trans_threshold)
+    stopping = stopping or {}
+    results, models = [], None
+    for k in states:
+        init = None
+        if models:
+            sample_folds = np.repeat(folds, lengths)
+            inits = []
+            for f, m in enumerate(models):
+                params = m.startprob_, m.transmat_, m.emissionprob_
+                occupancy = m.predict_proba(series, lengths)[sample_folds != f].sum(axis=0)
+                for _ in range(k - m.n_components):
+                    params = baumwelch.split_state(*(params + (occupancy,)))
+                    params, occupancy = params[:3], params[3]
+                inits.append(params)
+            init = [np.stack(p) for p in zip(*inits)]
+        tick = t.time()
+        models = None
+        if cache is not None:
+            keys = [cache.key(*obsfile.Trials(trials.path, [(0, start), (end, len(lengths))]).load(),
+                              n_states=k, n_iter=n_iter, tol=tol, engine='native', n_restarts=1,
+                              warm=init is not None, **dict(sparse, **stopping))
+                    for start, end in bounds]
+            models = [cache.get(key) for key in keys]
+            if any(m is None for m in models):
+                models = None
+            elif verbose: print('Found models in cache for n_states={}'.format(k))
+        if models is None:
+            path = None
+            if checkpoint is not None:
+                path = os.path.join(checkpoint, ModelCache.key(
+                    series, lengths, n_states=k, n_iter=n_iter, tol=tol, bounds=bounds,
+                    warm=init is not None, **dict(sparse, **stopping)) + '.npz')
+            models = baumwelch.fit_folds(series, lengths, folds, k, n_iter=n_iter, tol=tol,
+                                         n_features=n_features, init=init, checkpoint=path,
+                                         checkpoint_every=checkpoint_every, n_threads=n_threads,
+                                         **dict(sparse, **stopping))
+            if cache is not None:
+                for key, m in zip(keys, models):
+                    cache.put(key, m)
+        seconds = t.time() - tick
+        for m in models:
+            m.fit_time_ = seconds / len(models)  # So that the folds add up to the lockstep fit
+        # One event for all folds, fitted together: the longest fit spans all iterations
+        longest = max(models, key=lambda m: m.monitor_.iter)
+        with tracing.tagged(k=k):
+            tracing.emit('fit', seconds=seconds, engine='native', iter=longest.monitor_.iter,
+                         lockstep=True, folds=len(models))
+            tracing.iterations(longest.monitor_)
+        if verbose: print('Time fitting {} folds for n_states={}: {}s'.format(len(bounds), k,
+                                                                              t.time() - tick))
+        results.extend([[m, start, end], []] for m, (start, end) in zip(models, bounds))
+    return results
+
+
+def score_trials(m, series, lengths):
+    """ Returns the log-likelihood of each trial (series is N x 1) under model m. """
+    offsets = obsfile.offsets(lengths)
+    return [float(m.score(series[a:b])) for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def fold_result(m, series, lengths, start, end):
+    """
+    Scores model m on the held-out trials start to end, given as series and lengths.
+
+    Returns
+    -------
+    Dict with k, start, end, score (log-likelihood of the trials concatenated, as always used
+    for cross-validation), trial_scores (log-likelihood of each trial on its own), iter,
+    logprob and history (log-likelihood of the training trials, at the end and along EM; only
+    the last two iterations with hmmlearn), stopped (what ended EM, see baumwelch.Monitor),
+    fit_time and score_time, small enough to send back to the parent
+    """
+    tick = t.time()
+    series = series.reshape((series.size, 1))
+    result = {'k': m.n_components, 'start': start, 'end': end, 'score': float(m.score(series)),
+              'trial_scores': score_trials(m, series, lengths), 'iter': m.monitor_.iter,
+              'logprob': float(m.monitor_.history[-1]),
+              'history': [float(lp) for lp in m.monitor_.history],
+              'stopped': getattr(m.monitor_, 'stopped', None),
+              'fit_time': m.fit_time_, 'score_time': t.time() - tick}
+    tracing.emit('score', seconds=result['score_time'], k=m.n_components, fold=start)
+    return result
+
+
+def score_chain(training, testing, states, **kwargs):
+    """
+    Runs fit_chain() on the obsfile.Trials training and scores every model on testing,
+    within the worker process, so that no model is sent back to the parent.
+
+    Returns
+    -------
+    List with the output of fold_result() for each number of states
+    """
+    with tracing.tagged(fold=kwargs.get('start')):
+        results = fit_chain(training, states, **kwargs)
+        with tracing.span('load'):
+            series, lengths = testing.load()
+    return [fold_result(m, series, lengths, start, end) for [m, start, end], _ in results]
+
+
+def score_folds_chain(trials, states, bounds, **kwargs):
+    """
+    Runs fit_folds_chain() and scores the model of every fold on its held-out trials,
+    within the worker process.
+
+    Returns
+    -------
+    List with the output of fold_result() for every fold and state
+    """
+    results = fit_folds_chain(trials, states, bounds, **kwargs)
+    with tracing.span('load'):
+        series, lengths = trials.load()
+    offsets = obsfile.offsets(lengths)
+    return [fold_result(m, series[offsets[start]:offsets[end]], lengths[start:end], start, end)
+            for [m, start, end], _ in results]
+
+
+def race_fold(training, testing, k, start, end, init=None, **kwargs):
+    """
+    Fits k states on the obsfile.Trials training for at most kwargs['n_iter'] iterations,
+    from init (parameters returned by an earlier call, random if None), and scores the
+    model on testing, within the worker process.
+
+    Returns
+    -------
+    Output of fold_result(), with the parameters to continue the fit from under 'params'
+    and stopped 'n_iter' if the fit has not converged
+    """
+    with tracing.tagged(fold=start):
+        with tracing.span('load'):
+            series, lengths = training.load()
+        [m, _, _], _ = infer(series[:, None], lengths, k, viterbi=False, start=start, end=end,
+                             init=init, **kwargs)
+        with tracing.span('load'):
+            series, lengths = testing.load()
+    result = fold_result(m, series, lengths, start, end)
+    if result['stopped'] is None:  # hmmlearn
+        result['stopped'] = 'n_iter' if m.monitor_.iter == m.monitor_.n_iter else 'tol'
+    result['params'] = [m.startprob_, m.transmat_, m.emissionprob_]
+    return result
+
+
+def race(series, lengths, opts, path, journal):
+    """
+    Chooses the number of states among opts.states by successive halving on the
+    cross-validated score, with folds as in cross_validate().
+
+    In every round, the fits of each remaining k on each fold go on for up to
+    opts.race_budget iterations in the first round, and 1 / opts.race_keep times as many
+    in total in each round after that, continuing where they stopped. Only the best
+    fraction opts.race_keep of the values of k (by mean held-out log-likelihood over the
+    folds) go on to the next round. The race ends with one k left, or once all remaining
+    fits have converged or reached opts.max_iter iterations.
+
+    Returns
+    -------
+    The chosen k and the history: one dict per round with the iterations allowed so far
+    (budget), the score of every remaining k, the score, iterations and stopping reason
+    of each of its folds, and the values of k kept. Rounds are also recorded in journal.
+    """
+    l = int(np.floor(opts.trials / opts.nfold))
+    bounds = [(a, min(a + l, opts.trials)) for a in range(0, opts.trials, l)]
+    offsets = obsfile.offsets(lengths)
+    fits, history = {}, []
+    alive, done, budget = list(opts.states), 0, min(opts.race_budget, opts.max_iter)
+    with ProcessPoolExecutor(max_workers=opts.jobs) as ex:
+        while True:
+            sched = Scheduler(ex, opts.jobs)
+            for k in alive:
+                for start, end in bounds:
+                    previous = fits.get((k, start))
+                    if previous is not None and previous['stopped'] != 'n_iter':
+                        continue  # Converged in an earlier round
+                    sched.add([k], series.size - (offsets[end] - offsets[start]),
+                              tracing.task(race_fold),
+                              obsfile.Trials(path, [(0, start), (end, opts.trials)]),
+                              obsfile.Trials(path, [(start, end)]), k, start, end,
+                              init=previous and previous['params'], n_iter=budget - done,
+                              tol=opts.tol, stopping=opts.stopping, engine=opts.engine,
+                              n_restarts=opts.restarts, verbose=opts.verbose,
+                              n_transitions=opts.transitions,
+                              trans_threshold=opts.trans_threshold, runs=opts.rle,
+                              n_threads=opts.threads)
+            for task, fut in sched.as_completed():
+                r = tracing.collect(fut.result(), task.submitted)
+                sched.observe(task, [r['iter']])
+                previous = fits.get((r['k'], r['start']))
+                if previous is not None:
+                    r['iter'] += previous['iter']
+                    r['history'] = previous['history'] + r['history']
+                fits[(r['k'], r['start'])] = r
+            scores = {k: np.mean([fits[(k, start)]['score'] for start, _ in bounds]) for k in alive}
+            ranked = sorted(alive, key=lambda k: -scores[k])
+            keep = ranked[:max(1, int(np.ceil(len(alive) * opts.race_keep)))]
+            over = (len(keep) == 1 or budget >= opts.max_iter or
+                    all(fits[(k, start)]['stopped'] != 'n_iter' for k in keep for start, _ in bounds))
+            record = {'kind': 'race', 'round': len(history), 'budget': budget,
+                      'scores': {str(k): scores[k] for k in alive},
+                      'folds': {str(k): [{key: fits[(k, start)][key] for key in
+                                          ('start', 'end', 'score', 'iter', 'stopped')}
+                                         for start, _ in bounds] for k in alive},
+                      'kept': ranked[:1] if over else keep}
+            journal.append(record)
+            history.append(record)
+            print('Round {}, up to {} iterations: {}'.format(
+                record['round'], budget, ', '.join('k={} {:.4f}'.format(k, scores[k]) for k in ranked)))
+            if over:
+                return ranked[0], history
+            alive, done = keep, budget
+            budget = min(opts.max_iter, int(np.ceil(budget / opts.race_keep)))
+
+
+def chains(states, n=None):
+    """
+    Splits sorted states into n chains of consecutive values for fit_chain(), or into chains
+    of one (i.e. independent fits) if n is None.
+    """
+    states = sorted(states)
+    if n is None or not states:
+        return [[k] for k in states]
+    return [[int(k) for k in c] for c in np.array_split(states, min(n, len(states)))]
+
+
 # Alv's plotting
 def plot(series, viterbi_path, sr=250):
     """
@@ -107,58 +512,140 @@ def plot(series, viterbi_path, sr=250):
     -------
 
     """
-    df = viz.states(viterbi_path, sr, offset=0)
-    # ax = viz.ribbon(df, sr, col.cyclic_col(col.cm1.colors), y0=0, y_width=0.1999, group_col='state')
-    ax = viz.ribbon(df, sr, col.stdcolors(), y0=0, y_width=0.1999, group_col='state')
-    # viz.ribbon(viz.states(series, sr, offset=0), sr, col.cyclic_col(col.cm3.colors), y0=0.2, y_width=0.1999,
-    #            group_col='state', ax=ax)
-    viz.ribbon(viz.states(series, sr, offset=0), sr, col.stdcolors(), y0=0.2, y_width=0.1999,
-                group_col='state', ax=ax)
+    # The plotting stack (with pandas) is only loaded here, so that fitting does not pay for it
+    import matplotlib.pyplot as pl
+    import alv.vizcol as col
+    from alv import hmm_viz as viz
+    # Long recordings make millions of runs: draw them at the level of detail of the view
+    ax = viz.LodRibbon(viterbi_path, sr, col.stdcolors(), y0=0, y_width=0.1999).ax
+    # viz.LodRibbon(series, sr, col.cyclic_col(col.cm3.colors), y0=0.2, y_width=0.1999, ax=ax)
+    viz.LodRibbon(series, sr, col.stdcolors(), y0=0.2, y_width=0.1999, ax=ax)
     pl.show()
 
 
-def cross_validate(series, opts):
+def cross_validate(series, lengths, opts, path, journal):
     """
-    Reshapes the series as a num_trials x trial_length matrix, then splits its rows in N=opts.nfold subsets.
+    Splits the trials (of any lengths) in N=opts.nfold subsets of consecutive trials.
     For each k ∈ (1, max_states):
       Trains with one subset of trials then tests against the N-1 remaining (computes the log likelihood / score).
     Scores are averaged over all N training/test stages
+    Workers read their training and testing trials from path, an observations file holding series
+    (see obsfile.shared), and send back only the scores (see fold_result).
+    Every fold scored is recorded in journal, and folds already there are not fitted again.
+    With --abandon, the folds whose fit was abandoned are not scored: the score of each k is
+    averaged over its other folds, and a k whose fits were all abandoned is left out.
     """
     if opts.verbose: print("Performing cross-validation with {} folds".format(opts.nfold))
     scores = {k: 0 for k in opts.states}
-    trial_length = compute_lengths(series, opts.trials)[1]  # HACK
-    # trial_length = int(series.size / opts.trials)
-    # assert series.size % opts.trials == 0, 'Length of time series is not a multiple of number of trials'
-    view = series.reshape((opts.trials, trial_length))  # FIXME: Truly a view?
+    counted = {k: 0 for k in opts.states}
+    abandoned = {k: 0 for k in opts.states}
+    offsets = obsfile.offsets(lengths)
     l = int(np.floor(opts.trials / opts.nfold))
-    futures = []
+
+    def add(r):
+        """ Adds the score of fold record r to that of its k, unless the fit was abandoned. """
+        if r.get('stopped') == 'abandoned':
+            abandoned[r['k']] += 1
+        else:
+            scores[r['k']] += r['score']
+            counted[r['k']] += 1
+
+    done = {(r['k'], r['start']): r for r in journal.records('fold')}
+    for (k, _), r in done.items():
+        if k in scores:
+            add(r)
+    if opts.verbose and done: print('Resuming with {} folds already scored'.format(len(done)))
+    model = CostModel()
+    for r in journal.records('fold'):
+        model.add_iterations(r['k'], r['iter'])
+
+    def floors(task):
+        """
+        With --abandon, fits of a fold are abandoned once they cannot reach the training
+        log-likelihood of a fit with fewer states on the same fold, less the margin: a model
+        with more states can do at least as well, so such a fit is stuck in a worse optimum.
+        The fits with fewer states go first for that (see waits).
+        """
+        if opts.abandon is None or 'start' not in task.kwargs:
+            return
+        known = [(r['k'], r['logprob']) for r in journal.records('fold')
+                 if r['start'] == task.kwargs['start'] and r.get('logprob') is not None and
+                 r.get('stopped') != 'abandoned']
+        task.kwargs['floors'] = {k: max(lp for j, lp in known if j < k) - opts.abandon
+                                 for k in task.states if any(j < k for j, _ in known)}
+
+    def waits(task, other):
+        """ With --abandon, fits wait for those with fewer states on the same fold. """
+        return ('start' in task.kwargs and other.kwargs.get('start') == task.kwargs['start'] and
+                min(other.states) < min(task.states))
+
     with ProcessPoolExecutor(max_workers=opts.jobs) as ex:
-        for k in opts.states:
+        sched = Scheduler(ex, opts.jobs, model, prepare=floors,
+                          waits=waits if opts.abandon is not None else None)
+        for chain in chains(opts.states, opts.jobs if opts.sweep else None):
+            if opts.lockstep:
+                bounds = [(a, min(a + l, opts.trials)) for a in range(0, opts.trials, l)]
+                if all((k, start) in done for k in chain for start, _ in bounds):
+                    continue
+                sched.add(chain, series.size * len(bounds), tracing.task(score_folds_chain),
+                          obsfile.Trials(path), chain, bounds, n_iter=opts.max_iter, tol=opts.tol,
+                          stopping=opts.stopping, verbose=opts.verbose, cache=opts.cache,
+                          checkpoint=opts.checkpoint, checkpoint_every=opts.checkpoint_every,
+                          n_transitions=opts.transitions, trans_threshold=opts.trans_threshold,
+                          n_threads=opts.threads)
+                continue
             off = 0
             #if opts.verbose: print('Computing scores for k= {} states'.format(k))
             while off < opts.trials:
                 start = off
                 end = min(off+l, opts.trials)
                 off = end
-                training_trials = start + opts.trials-end
-                training = view[range(0, start) +
-                                range(end, opts.trials)].reshape(((start + opts.trials - end) *
-                                                                  trial_length, 1))
-                training_lengths = compute_lengths(training, training_trials)
+                if all((k, start) in done for k in chain):
+                    continue
+                training = obsfile.Trials(path, [(0, start), (end, opts.trials)])
+                testing = obsfile.Trials(path, [(start, end)])
                 # if opts.verbose: print('\tFitting for fold #{}'.format(int(np.ceil(off/l))))
-                futures.append(ex.submit(infer, training, lengths=training_lengths, n_states=k,
-                                         viterbi=False, verbose=opts.verbose, start=start, end=end))
+                sched.add(chain, series.size - (offsets[end] - offsets[start]),
+                          tracing.task(score_chain), training, testing, chain, viterbi=False,
+                          verbose=opts.verbose, start=start, end=end, n_iter=opts.max_iter,
+                          tol=opts.tol, stopping=opts.stopping,
+                          engine=opts.engine, n_restarts=opts.restarts, cache=opts.cache,
+                          checkpoint=opts.checkpoint, checkpoint_every=opts.checkpoint_every,
+                          n_transitions=opts.transitions, trans_threshold=opts.trans_threshold,
+                          runs=opts.rle, n_threads=opts.threads)
                 # m, _ = infer(training, training_lengths, n_states=k, viterbi=False, verbose=opts.verbose)
 
-    for fut in as_completed(futures):
-        [m, start, end], _ = fut.result()
-        k = m.n_components
-        testing = view[start:end].reshape(((end-start)*trial_length, 1))
-        scores[k] += m.score(testing)
-        if opts.verbose: print("\tScore for fold {} - {}: {}".format(start, end, scores[k]))
-    for k in scores.keys():
-        scores[k] /= np.ceil(opts.trials/l)  # Average score over the number of splits
-    return scores
+        for task, fut in sched.as_completed():
+            results = tracing.collect(fut.result(), task.submitted)
+            sched.observe(task, [max(r['iter'] for r in results if r['k'] == k) for k in task.states])
+            if opts.verbose: print("\tFitted n_states={} in {:.1f}s (predicted cost {:.3g})"
+                                   .format(task.states, task.seconds, task.predicted))
+            for r in results:
+                k = r['k']
+                if (k, r['start']) in done:
+                    continue
+                add(r)
+                r['kind'] = 'fold'
+                journal.append(r)
+                if opts.verbose: print("\tScore for k={} fold {} - {}: {} ({} iterations, {}, "
+                                       "std. across trials {:.2f})"
+                                       .format(k, r['start'], r['end'], scores[k], r['iter'],
+                                               r['stopped'], np.std(r['trial_scores'])))
+    journal.append({'kind': 'schedule', 'jobs': opts.jobs, 'wall': sched.wall, 'busy': sched.busy,
+                    'utilisation': sched.utilisation})
+    if opts.verbose: print("Worker utilisation: {:.0%} of {} jobs over {:.1f}s"
+                           .format(sched.utilisation, opts.jobs, sched.wall))
+    if opts.verbose and any(abandoned.values()):
+        print("Folds abandoned: {}".format({k: n for k, n in abandoned.items() if n}))
+    # Average score over the folds scored
+    return {k: scores[k] / counted[k] for k in scores if counted[k]}
+
+
+def report_trace(path):
+    """ Writes the events of the run (see tracing.py) to path and prints a summary, if path. """
+    if path:
+        tracing.write(path)
+        print(tracing.summary())
 
 
 # WARNING: callables run by the Executor must be pickl-able
@@ -166,27 +653,105 @@ def cross_validate(series, opts):
 def main(argv):
     np.random.seed(42)
     opts = options.parse(argv)
+    if opts.trace:
+        tracing.enable()
+    if opts.cache:
+        opts.cache = ModelCache(opts.cache, opts.cache_size << 20)
     if opts.verbose:
         print("Loading file {}".format(opts.input_file))
-    series = load_observations(opts.input_file, opts.shift)
-    lengths = compute_lengths(series, opts.trials)
+    with tracing.span('load'):
+        series = load_observations(opts.input_file, opts.shift)
+    if obsfile.is_obsfile(opts.input_file):
+        lengths = obsfile.read_header(opts.input_file)['lengths']
+    elif opts.lengths:
+        lengths = load_lengths(opts.lengths, series)
+    else:
+        lengths = compute_lengths(series, opts.trials)
+    opts.trials = len(lengths)
+    if opts.decode:
+        if opts.verbose: print("Decoding with model {}".format(opts.decode))
+        with tracing.span('decode'):
+            stream_decode(series, lengths, baumwelch.load_model(opts.decode), opts.output_file,
+                          verbose=opts.verbose)
+        report_trace(opts.trace)
+        return
     if opts.verbose:
         print("Working with n_states={0}, trials={1}, jobs={2}"
               .format(opts.states, opts.trials, opts.jobs))
 
-    if opts.nfold:
-        scores = cross_validate(series, opts)
-        print("Final scores= {}".format(scores))
-    else:
-        with ProcessPoolExecutor(max_workers=opts.jobs) as ex:
-            n = len(opts.states)
-            for [m, _, _], vpath in ex.map(infer, [series[:, None]] * n, [lengths] * n, opts.states,
-                                   [True] * n, [opts.verbose] * n):
-                if opts.output_file:
-                    save_viterbi(vpath, opts.output_file)
-                # plot(series, vpath)
-                print("Transition matrix:\n{}".format(np.round(m.transmat_, 2)))
-                print("Initial probability:\n{}".format(np.round(m.startprob_, 2)))
+    journal = Journal(opts.output_file + '.journal', resume=opts.resume)
+    # Every option which changes what is fitted or how it is scored: resuming with any other
+    # value would mix results of different runs
+    run = {'kind': 'run', 'input_file': opts.input_file, 'trials': opts.trials,
+           'lengths': opts.lengths, 'shift': opts.shift, 'states': list(opts.states),
+           'nfold': opts.nfold, 'engine': opts.engine, 'restarts': opts.restarts,
+           'max_iter': opts.max_iter, 'tol': opts.tol, 'abandon': opts.abandon,
+           'transitions': opts.transitions, 'trans_threshold': opts.trans_threshold,
+           'rle': opts.rle, 'lockstep': opts.lockstep, 'sweep': opts.sweep, 'race': opts.race,
+           'race_budget': opts.race_budget, 'race_keep': opts.race_keep}
+    if opts.stopping:
+        run['stopping'] = opts.stopping
+    previous = journal.records('run')
+    if not previous:
+        journal.append(run)
+    elif previous[0] != run:
+        print('ERROR: cannot resume, journal {} is for another run: {}'
+              .format(journal.path, previous[0]))
+        sys.exit(2)
+    opts.checkpoint = None
+    if opts.checkpoint_every > 0:
+        opts.checkpoint = opts.output_file + '.checkpoints'
+        if not opts.resume and os.path.isdir(opts.checkpoint):
+            shutil.rmtree(opts.checkpoint)  # Fits only continue from checkpoints with --resume
+        if not os.path.isdir(opts.checkpoint):
+            os.makedirs(opts.checkpoint)
+
+    with obsfile.shared(series, lengths, opts.input_file) as path:
+        if opts.race:
+            k, _ = race(series, lengths, opts, path, journal)
+            print("Chosen n_states= {}".format(k))
+        elif opts.nfold:
+            scores = cross_validate(series, lengths, opts, path, journal)
+            print("Final scores= {}".format(scores))
+        else:
+            fitted = set(r['k'] for r in journal.records('fit'))
+            if opts.verbose and fitted: print('Already fitted: n_states={}'.format(sorted(fitted)))
+            states = [k for k in opts.states if k not in fitted]
+            with ProcessPoolExecutor(max_workers=opts.jobs) as ex:
+                fit = partial(fit_chain, obsfile.Trials(path), viterbi=True, verbose=opts.verbose,
+                              n_iter=opts.max_iter, tol=opts.tol, stopping=opts.stopping,
+                              engine=opts.engine, n_restarts=opts.restarts, cache=opts.cache,
+                              checkpoint=opts.checkpoint, checkpoint_every=opts.checkpoint_every,
+                              n_transitions=opts.transitions,
+                              trans_threshold=opts.trans_threshold, runs=opts.rle,
+                              time_blocks=opts.time_blocks, n_threads=opts.threads)
+                for out in ex.map(tracing.task(fit),
+                                  chains(states, opts.jobs if opts.sweep else None)):
+                    for [m, _, _], vpath in tracing.collect(out):
+                        if opts.output_file:
+                            with tracing.span('save', k=m.n_components):
+                                save_viterbi(vpath, opts.output_file)
+                                model_file = '{}.k{}.npz'.format(opts.output_file, m.n_components)
+                                baumwelch.save_model(m, model_file)
+                            journal.append({'kind': 'fit', 'k': m.n_components,
+                                            'iter': m.monitor_.iter,
+                                            'logprob': m.monitor_.history[-1],
+                                            'history': [float(lp) for lp in m.monitor_.history],
+                                            'stopped': getattr(m.monitor_, 'stopped', None),
+                                            'model': model_file})
+                        # plot(series, vpath)
+                        print("Iterations for n_states={}: {}".format(m.n_components, m.monitor_.iter))
+                        print("Transition matrix:\n{}".format(np.round(m.transmat_, 2)))
+                        print("Initial probability:\n{}".format(np.round(m.startprob_, 2)))
+            if opts.figures:
+                fits = sorted(dict((r['k'], r['model']) for r in journal.records('fit')).items())
+                with tracing.span('figures'):
+                    rendered, skipped = figures.export(path, fits, opts.figures,
+                                                       opts.figure_format, opts.jobs,
+                                                       verbose=opts.verbose)
+                print("Figures saved to {}: {} rendered, {} up to date"
+                      .format(opts.figures, rendered, skipped))
+    report_trace(opts.trace)
 
 
 if __name__ == '__main__':
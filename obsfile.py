@@ -0,0 +1,276 @@
+# coding=utf-8
+"""
+Binary container for series of observations, meant to be memory-mapped.
+
+Layout of a file:
+
+    [0, 8)                   MAGIC
+    [8, HEADER_SIZE)         JSON header padded with spaces: dtype, n_samples, trials,
+                             shift, n_features and lengths_offset
+    [HEADER_SIZE, ...)       the concatenated trials, n_samples items of dtype
+    [lengths_offset, ...)    lengths of the trials (int64)
+
+The series is stored already shifted to start at 0, so it can be used directly as
+read-only memory map and all processes opening the file share the same pages.
+Trials may have different lengths: they are packed one after the other, and trial i
+spans offsets(lengths)[i] to offsets(lengths)[i + 1] of the series.
+
+The same files serve to hand data to worker processes: see shared() and Trials.
+
+Text files as read by main.load_observations can be converted once with:
+
+    python obsfile.py -i <input-file> -o <output-file> -t <trials> [-f <shift>]
+
+or, for trials of different lengths, with a text file of the lengths:
+
+    python obsfile.py -i <input-file> -o <output-file> -l <lengths-file> [-f <shift>]
+"""
+from __future__ import print_function, division
+import getopt
+import json
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+MAGIC = b'MSTATES\x01'
+HEADER_SIZE = 4096
+
+
+def offsets(lengths):
+    """ Returns the offset of each trial in the packed series, followed by the total length. """
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+
+def is_obsfile(path):
+    """ Whether path is a file in this format (as opposed to text). """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(path):
+    """ Returns the header as a dict, with the lengths of trials under 'lengths'. """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an observations file'.format(path))
+        header = json.loads(f.read(HEADER_SIZE - len(MAGIC)).decode('utf-8'))
+    header['lengths'] = np.array(np.memmap(path, dtype='<i8', mode='r', shape=(header['trials'],),
+                                           offset=header['lengths_offset']))
+    return header
+
+
+def load(path):
+    """ Returns a read-only memory map of the series in path and its header. """
+    header = read_header(path)
+    series = np.memmap(path, dtype=header['dtype'], mode='r', shape=(header['n_samples'],),
+                       offset=HEADER_SIZE)
+    return series, header
+
+
+def _write_header(f, header):
+    raw = json.dumps(header, sort_keys=True).encode('utf-8')
+    if len(raw) > HEADER_SIZE - len(MAGIC):
+        raise ValueError('Header too long')
+    f.seek(0)
+    f.write(MAGIC + raw + b' ' * (HEADER_SIZE - len(MAGIC) - len(raw)))
+
+
+def _finish(f, header, lengths):
+    """ Appends the lengths of trials at the current position and writes the header. """
+    lengths = np.asarray(lengths, dtype='<i8')
+    if lengths.sum() != header['n_samples']:
+        raise ValueError('Lengths add up to {}, but there are {} samples'
+                         .format(lengths.sum(), header['n_samples']))
+    header.update(trials=int(lengths.size), lengths_offset=f.tell())
+    f.write(lengths.tobytes())
+    _write_header(f, header)
+
+
+class Writer(object):
+    """
+    Writes an observations file incrementally, for series which do not fit in memory.
+
+    Usage:
+        w = Writer(path)
+        for chunk in chunks:
+            w.append(chunk)
+        w.close(lengths)
+    """
+
+    def __init__(self, path, dtype=np.int8, shift=0):
+        self.header = {'dtype': np.dtype(dtype).str, 'n_samples': 0, 'shift': shift,
+                       'n_features': 0}
+        self.f = open(path, 'wb')
+        self.f.seek(HEADER_SIZE)
+
+    def append(self, chunk):
+        """ Appends values, already shifted to start at 0. """
+        chunk = np.asarray(chunk).ravel()
+        if chunk.size == 0:
+            return
+        if chunk.min() < 0:
+            raise ValueError('Observations must be non negative, wrong shift?')
+        self.header['n_samples'] += int(chunk.size)
+        self.header['n_features'] = max(self.header['n_features'], int(chunk.max()) + 1)
+        self.f.write(chunk.astype(self.header['dtype']).tobytes())
+
+    def close(self, lengths=None):
+        """ Writes the lengths of trials (one trial with everything if None) and the header. """
+        if lengths is None:
+            lengths = [self.header['n_samples']]
+        _finish(self.f, self.header, lengths)
+        self.f.close()
+
+
+def write(path, series, lengths, shift=0):
+    """
+    Writes a series to path.
+
+    Parameters
+    ----------
+    series: array of non negative integers, already shifted to start at 0
+    lengths: lengths of the trials
+    shift: shift which was applied to the original data, only kept for reference
+    """
+    series = np.asarray(series)
+    w = Writer(path, series.dtype, shift)
+    w.append(series)
+    w.close(lengths)
+
+
+@contextmanager
+def shared(series, lengths, path=None):
+    """
+    Provides an observations file holding series, for worker processes to memory-map.
+
+    If path is already such a file it is used as is. Otherwise series is written to a
+    temporary file (in /dev/shm if available, i.e. in shared memory), which is removed
+    on exit.
+
+    Usage:
+        with shared(series, lengths, input_file) as path:
+            ex.submit(fn, Trials(path, [(0, 3)]), ...)
+    """
+    if path is not None and is_obsfile(path):
+        yield path
+        return
+    fd, tmp = tempfile.mkstemp(suffix='.obs', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    try:
+        write(tmp, series, lengths)
+        yield tmp
+    finally:
+        os.remove(tmp)
+
+
+class Trials(object):
+    """
+    Picklable reference to some of the trials in an observations file. Only the path and
+    the trial indices are sent to worker processes, which then map the file themselves.
+
+    Parameters
+    ----------
+    path: observations file
+    ranges: list of (first, last) ranges of trials to use, last excluded. None for all.
+    """
+
+    def __init__(self, path, ranges=None):
+        self.path = path
+        self.ranges = ranges
+
+    def load(self):
+        """
+        Returns the selected trials (concatenated) and their lengths. The series is a view
+        of the memory map if the trials are contiguous, and a copy otherwise.
+        """
+        series, header = load(self.path)
+        lengths = header['lengths']
+        if self.ranges is None:
+            return series, lengths
+        bounds = offsets(lengths)
+        ranges = [(a, b) for a, b in self.ranges if b > a]
+        parts = [series[bounds[a]:bounds[b]] for a, b in ranges]
+        lengths = np.concatenate([lengths[a:b] for a, b in ranges])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts), lengths
+
+
+def convert(input_file, output_file, trials=1, shift=-1, dtype=np.int8, chunk_size=1 << 24,
+            lengths=None):
+    """
+    Converts a text file of integers (as read by main.load_observations) without loading
+    it into memory at once.
+
+    Parameters
+    ----------
+    input_file, output_file
+    trials: number of trials of equal length in the file
+    lengths: lengths of the trials, if they differ (trials is then ignored)
+    shift: added to every value, see main.load_observations
+    dtype: of the stored series
+    chunk_size: approximate number of bytes of text parsed at a time
+
+    Returns
+    -------
+    The header of the new file
+    """
+    w = Writer(output_file, dtype, shift)
+    with open(input_file, 'r') as src:
+        while True:
+            lines = src.readlines(chunk_size)
+            if not lines:
+                break
+            w.append(np.fromstring(''.join(lines), dtype=np.int64, sep=' ') + shift)
+    n = w.header['n_samples']
+    if lengths is None:
+        if n % trials != 0:
+            w.f.close()
+            raise ValueError('Length of time series is not a multiple of number of trials')
+        lengths = np.full(trials, n // trials, dtype=int)
+    try:
+        w.close(lengths)
+    except ValueError:
+        w.f.close()
+        raise
+    return w.header
+
+
+def main(argv):
+    usage_str = str(
+        "Usage: python obsfile.py -i <input-file> -o <output-file>\n\nOther options:\n"
+        "    -h, --help           This help\n"
+        "    -t, --trials         Number of trials in input file [default=1]\n"
+        "    -l, --lengths        Text file with the length of each trial, for trials\n"
+        "                         of different lengths (overrides -t)\n"
+        "    -f, --shift          Apply shift to data in input file [default=-1]")
+    try:
+        vals, args = getopt.getopt(argv, 'hi:o:t:l:f:',
+                                   ['help', 'input-file=', 'output-file=', 'trials=', 'lengths=',
+                                    'shift='])
+    except getopt.GetoptError as error:
+        print('ERROR: ' + error.msg + '\n' + usage_str)
+        sys.exit(2)
+    input_file, output_file, trials, lengths, shift = None, None, 1, None, -1
+    for opt, arg in vals:
+        if opt in ('-h', '--help'):
+            print(usage_str)
+            sys.exit()
+        elif opt in ('-i', '--input-file'):
+            input_file = arg
+        elif opt in ('-o', '--output-file'):
+            output_file = arg
+        elif opt in ('-t', '--trials'):
+            trials = int(arg)
+        elif opt in ('-l', '--lengths'):
+            lengths = np.loadtxt(arg, dtype=np.int64, ndmin=1)
+        elif opt in ('-f', '--shift'):
+            shift = int(arg)
+    if not input_file or not output_file:
+        print('ERROR: input and output files required\n' + usage_str)
+        sys.exit(1)
+    header = convert(input_file, output_file, trials, shift, lengths=lengths)
+    print('Wrote {n_samples} samples in {trials} trials, {n_features} symbols'.format(**header))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
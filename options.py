@@ -8,7 +8,15 @@ from bunch import Bunch
 
 def parse(argv):
     opts = Bunch({'input_file': None, 'output_file': None, 'shift': -1, 'jobs': 1, 'trials': 1,
-                  'states': [2], 'nfold': None, 'auto': False, 'verbose': False})
+                  'lengths': None, 'states': [2], 'nfold': None, 'auto': False, 'engine': 'hmmlearn',
+                  'restarts': 1, 'sweep': False, 'lockstep': False, 'decode': None,
+                  'cache': None, 'cache_size': 1024, 'resume': False,
+                  'checkpoint_every': 100, 'transitions': None, 'trans_threshold': 0.,
+                  'rle': False, 'time_blocks': None, 'threads': 1, 'trace': None,
+                  'max_iter': 4000, 'tol': 1e-6, 'rtol': 0., 'patience': 1, 'time_budget': None,
+                  'param_tol': None, 'abandon': None, 'race': False,
+                  'race_budget': 10, 'race_keep': 0.5, 'figures': None,
+                  'figure_format': 'png', 'verbose': False})
     usage_str = str(
         "Usage: python metastates.py -i <input-file> -o <output-file>\n\nOther options:\n"
         "    -h, --help           This help\n"
@@ -17,19 +25,89 @@ def parse(argv):
         "                         [default=input-file.out]\n"
         "    -f, --shift          Apply shift to data in input file [default={0}]\n"
         "    -t, --trials         Set number of trials for input file [default={2}]\n"
+        "        --lengths        Text file with the length of each trial, for trials\n"
+        "                         of different lengths (overrides -t)\n"
         "    -s, --states         Number of states to use [default={3}]\n"
         "                         (interpreted as a maximum when cross-validating)\n"
         "    -a, --auto           Parse input filename for number of trials and\n"
         "                         number of states (overrides -s, -t) [default={4}]\n"
         "    -c, --crossval       Perform n-fold cross-validation [default n={5}]\n"
         "    -j, --jobs           Number of concurrent jobs to launch [default={1}]\n"
+        "        --threads        Number of threads sharing the trials within each\n"
+        "                         fit (native engine) [default={16}]\n"
+        "    -e, --engine         EM implementation: hmmlearn or native [default={6}]\n"
+        "    -r, --restarts       Number of random initialisations per fit, only\n"
+        "                         the best one is kept [default={7}]\n"
+        "    -w, --sweep          Start each fit from the one with fewer states, in\n"
+        "                         one chain of consecutive states per job [default={8}]\n"
+        "    -l, --lockstep       Fit all cross-validation folds together, in one pass\n"
+        "                         over the data (native engine, no restarts) [default={9}]\n"
+        "    -d, --decode         Do not fit, decode with the model in this file (as\n"
+        "                         saved next to the output file) in bounded memory\n"
+        "    -k, --cache          Directory to cache fitted models in [default={10}]\n"
+        "        --cache-size     Maximum size of the cache in MB [default={11}]\n"
+        "        --resume         Skip the fits and folds recorded as done in the\n"
+        "                         journal next to the output file, and resume\n"
+        "                         interrupted fits from their checkpoints\n"
+        "        --checkpoint-every\n"
+        "                         Checkpoint native fits every N iterations, 0 to\n"
+        "                         disable [default={12}]\n"
+        "        --transitions    Keep only the N most likely transitions out of each\n"
+        "                         state (native engine) [default={13}]\n"
+        "        --trans-threshold\n"
+        "                         Drop transitions less likely than this during EM\n"
+        "                         (native engine) [default={14}]\n"
+        "        --rle            Fit the run-length encoded series, faster if it is\n"
+        "                         made of long runs (native engine) [default={15}]\n"
+        "        --time-blocks    Split the series into N blocks of time, fitted and\n"
+        "                         decoded in parallel on N processes per fit, for few\n"
+        "                         long trials (native engine, no cross-validation or\n"
+        "                         --threads)\n"
+        "        --max-iter       Maximum number of EM iterations per fit [default={17}]\n"
+        "        --tol            EM stops once the log-likelihood improves by less than\n"
+        "                         this [default={18}]...\n"
+        "        --rtol           ... or by less than this fraction of its absolute\n"
+        "                         value (native engine) [default={19}]...\n"
+        "        --patience       ... in that many iterations in a row (native engine)\n"
+        "                         [default={20}]\n"
+        "        --time-budget    Stop every fit after this many seconds (native\n"
+        "                         engine)\n"
+        "        --param-tol      Stop once no parameter changes by more than this in\n"
+        "                         an iteration (native engine)\n"
+        "        --abandon        When cross-validating, abandon fits whose log-\n"
+        "                         likelihood cannot come within this margin of that of\n"
+        "                         a fit with fewer states on the same fold (native\n"
+        "                         engine, without --lockstep)\n"
+        "        --race           Choose the number of states by successive halving\n"
+        "                         over the cross-validation folds (requires -c)\n"
+        "        --race-budget    Iterations of every fit in the first round of the\n"
+        "                         race [default={21}]\n"
+        "        --race-keep      Fraction of the numbers of states kept after each\n"
+        "                         round, budgets grow by its inverse [default={22}]\n"
+        "        --trace          Write timing events of every phase (tagged with k and\n"
+        "                         fold) to this file as JSON lines, and print a summary\n"
+        "        --figures        Save figures of the Viterbi path and observations of\n"
+        "                         every trial for every n_states fitted to this\n"
+        "                         directory (without -c), skipping those up to date\n"
+        "        --figure-format  Format of the figures, png or svg [default={23}]\n"
         "    -v, --verbose        Display progress and time information")\
-        .format(opts.shift, opts.jobs, opts.trials, opts.states, opts.auto, opts.nfold)
+        .format(opts.shift, opts.jobs, opts.trials, opts.states, opts.auto, opts.nfold, opts.engine,
+                opts.restarts, opts.sweep, opts.lockstep, opts.cache, opts.cache_size,
+                opts.checkpoint_every, opts.transitions, opts.trans_threshold,
+                opts.rle, opts.threads, opts.max_iter, opts.tol, opts.rtol, opts.patience,
+                opts.race_budget, opts.race_keep, opts.figure_format)
     try:
-        vals, args = getopt.getopt(argv, 'hi:o:f:t:s:ac:j:v',
+        vals, args = getopt.getopt(argv, 'hi:o:f:t:s:ac:j:e:r:wld:k:v',
                                    ['help', 'input-file=', 'output-file=', 'shift=',
-                                    'trials=', 'states=', 'auto',
-                                    'crossval=', 'jobs=', 'verbose'])
+                                    'trials=', 'lengths=', 'states=', 'auto',
+                                    'crossval=', 'jobs=', 'engine=', 'restarts=',
+                                    'sweep', 'lockstep', 'decode=', 'cache=', 'cache-size=',
+                                    'resume', 'checkpoint-every=', 'transitions=',
+                                    'trans-threshold=', 'rle', 'time-blocks=', 'threads=',
+                                    'trace=', 'max-iter=', 'tol=', 'rtol=', 'patience=',
+                                    'time-budget=', 'param-tol=', 'abandon=', 'race',
+                                    'race-budget=', 'race-keep=', 'figures=',
+                                    'figure-format=', 'verbose'])
     except getopt.GetoptError as error:
         print('ERROR: ' + error.msg + '\n' + usage_str)
         sys.exit(2)
@@ -45,6 +123,8 @@ def parse(argv):
             opts.shift = int(arg)
         elif opt in ('-t', '--trials'):
             opts.trials = int(arg)
+        elif opt == '--lengths':
+            opts.lengths = arg
         elif opt in ('-s', '--states'):
             opts.states = utils.parse_ranges(arg)
         elif opt in ('-a', '--auto'):
@@ -53,6 +133,66 @@ def parse(argv):
             opts.nfold = int(arg)
         elif opt in ('-j', '--jobs'):
             opts.jobs = int(arg)
+        elif opt in ('-e', '--engine'):
+            if arg not in ('hmmlearn', 'native'):
+                print('ERROR: unknown engine ' + arg + '\n' + usage_str)
+                sys.exit(2)
+            opts.engine = arg
+        elif opt in ('-r', '--restarts'):
+            opts.restarts = int(arg)
+        elif opt in ('-w', '--sweep'):
+            opts.sweep = True
+        elif opt in ('-l', '--lockstep'):
+            opts.lockstep = True
+        elif opt in ('-d', '--decode'):
+            opts.decode = arg
+        elif opt in ('-k', '--cache'):
+            opts.cache = arg
+        elif opt == '--cache-size':
+            opts.cache_size = int(arg)
+        elif opt == '--resume':
+            opts.resume = True
+        elif opt == '--checkpoint-every':
+            opts.checkpoint_every = int(arg)
+        elif opt == '--transitions':
+            opts.transitions = int(arg)
+        elif opt == '--trans-threshold':
+            opts.trans_threshold = float(arg)
+        elif opt == '--rle':
+            opts.rle = True
+        elif opt == '--threads':
+            opts.threads = int(arg)
+        elif opt == '--time-blocks':
+            opts.time_blocks = int(arg)
+        elif opt == '--max-iter':
+            opts.max_iter = int(arg)
+        elif opt == '--tol':
+            opts.tol = float(arg)
+        elif opt == '--rtol':
+            opts.rtol = float(arg)
+        elif opt == '--patience':
+            opts.patience = int(arg)
+        elif opt == '--time-budget':
+            opts.time_budget = float(arg)
+        elif opt == '--param-tol':
+            opts.param_tol = float(arg)
+        elif opt == '--abandon':
+            opts.abandon = float(arg)
+        elif opt == '--race':
+            opts.race = True
+        elif opt == '--race-budget':
+            opts.race_budget = int(arg)
+        elif opt == '--race-keep':
+            opts.race_keep = float(arg)
+        elif opt == '--trace':
+            opts.trace = arg
+        elif opt == '--figures':
+            opts.figures = arg
+        elif opt == '--figure-format':
+            if arg not in ('png', 'svg'):
+                print('ERROR: unknown figure format ' + arg + '\n' + usage_str)
+                sys.exit(2)
+            opts.figure_format = arg
         elif opt in ('-v', '--verbose'):
             opts.verbose = True
 
@@ -60,6 +200,51 @@ def parse(argv):
         print('ERROR: input file required\n' + usage_str)
         sys.exit(1)
 
+    if opts.lockstep and opts.engine != 'native':
+        print('ERROR: --lockstep requires --engine native\n' + usage_str)
+        sys.exit(2)
+
+    if opts.lockstep and (opts.restarts > 1 or opts.abandon is not None):
+        print('ERROR: --lockstep does not support --restarts or --abandon\n' + usage_str)
+        sys.exit(2)
+
+    if (opts.transitions is not None or opts.trans_threshold) and opts.engine != 'native':
+        print('ERROR: --transitions and --trans-threshold require --engine native\n' + usage_str)
+        sys.exit(2)
+
+    if opts.rle and (opts.engine != 'native' or opts.lockstep):
+        print('ERROR: --rle requires --engine native, without --lockstep\n' + usage_str)
+        sys.exit(2)
+
+    if opts.threads > 1 and opts.engine != 'native':
+        print('ERROR: --threads requires --engine native\n' + usage_str)
+        sys.exit(2)
+
+    # Stopping policies of the native engine which differ from hmmlearn's
+    opts.stopping = {name: value for name, value, default in
+                     (('rtol', opts.rtol, 0.), ('patience', opts.patience, 1),
+                      ('max_time', opts.time_budget, None), ('param_tol', opts.param_tol, None))
+                     if value != default}
+    if (opts.stopping or opts.abandon is not None) and opts.engine != 'native':
+        print('ERROR: --rtol, --patience, --time-budget, --param-tol and --abandon require '
+              '--engine native\n' + usage_str)
+        sys.exit(2)
+
+    if opts.race and (not opts.nfold or opts.lockstep or not 0 < opts.race_keep < 1):
+        print('ERROR: --race requires -c, without --lockstep, and 0 < --race-keep < 1\n' +
+              usage_str)
+        sys.exit(2)
+
+    if opts.figures and opts.nfold:
+        print('ERROR: --figures requires fits without -c\n' + usage_str)
+        sys.exit(2)
+
+    if opts.time_blocks and (opts.engine != 'native' or opts.rle or opts.nfold or
+                             opts.threads > 1):
+        print('ERROR: --time-blocks requires --engine native, without --rle, -c or --threads\n' +
+              usage_str)
+        sys.exit(2)
+
     opts.output_file = opts.output_file or opts.input_file + '.out'
 
     if opts.auto:
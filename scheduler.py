@@ -0,0 +1,135 @@
+# coding=utf-8
+"""
+Scheduling of fits on a process pool by predicted cost, longest first.
+
+An EM fit costs about k² × T × iterations, for k states and T training samples. The
+number of iterations is not known in advance: it is predicted from the fits already
+done for the same k (or the nearest ones), and the seconds per unit of k² × T × iteration
+from the runtimes measured so far. Only as many tasks as there are workers are in flight
+at any time, so every new submission uses all the runtimes observed until then, as well
+as the results of the tasks it should wait for (see Scheduler).
+"""
+from __future__ import print_function, division
+import time as t
+import numpy as np
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+class CostModel(object):
+    """
+    Parameters
+    ----------
+    default_iter: iterations assumed for any k until some fit is observed
+    """
+
+    def __init__(self, default_iter=100):
+        self.default_iter = default_iter
+        self.iters = {}
+        self.work = 0.
+        self.seconds = 0.
+
+    def iterations(self, k):
+        """ Predicted number of iterations of a fit with k states. """
+        if not self.iters:
+            return self.default_iter
+        known = sorted(self.iters)
+        return np.interp(k, known, [np.mean(self.iters[j]) for j in known])
+
+    def add_iterations(self, k, n_iter):
+        self.iters.setdefault(k, []).append(n_iter)
+
+    def observe(self, states, n_samples, iters, seconds):
+        """ Records that fitting states (with iters iterations each) took seconds. """
+        for k, n_iter in zip(states, iters):
+            self.add_iterations(k, n_iter)
+        self.work += sum(k * k * n_samples * n_iter for k, n_iter in zip(states, iters))
+        self.seconds += seconds
+
+    def predict(self, states, n_samples):
+        """ Predicted cost of fitting states on n_samples, in seconds once a runtime is known. """
+        work = sum(k * k * n_samples * self.iterations(k) for k in states)
+        return work * self.seconds / self.work if self.work else work
+
+
+class Task(object):
+    def __init__(self, states, n_samples, fn, args, kwargs):
+        self.states, self.n_samples = states, n_samples
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.predicted = self.submitted = self.seconds = None
+
+
+class Scheduler(object):
+    """
+    Usage:
+        s = Scheduler(ex, jobs)
+        s.add([2, 3], n_samples, fit_chain, trials, [2, 3])
+        for task, fut in s.as_completed():
+            s.observe(task, iterations_of(fut.result()))
+        print(s.utilisation)
+
+    Parameters
+    ----------
+    ex: executor
+    slots: number of workers of ex
+    model: CostModel, e.g. with iterations known from a previous run
+    prepare: called with each task just before it is submitted, e.g. to update its kwargs
+             with results known by then
+    waits: waits(task, other) tells whether task should wait for other to be done. Tasks
+           not waiting for any pending or running one are submitted first (longest first
+           among them), so that prepare sees the results of the others. When all wait, the
+           longest one is submitted anyway rather than leaving a worker idle.
+    """
+
+    def __init__(self, ex, slots, model=None, prepare=None, waits=None):
+        self.ex = ex
+        self.slots = slots
+        self.model = model or CostModel()
+        self.prepare = prepare
+        self.waits = waits
+        self.pending = []
+        self.busy = 0.
+        self.wall = 0.
+
+    def add(self, states, n_samples, fn, *args, **kwargs):
+        """ Queues fn(*args, **kwargs), which fits states on n_samples training samples. """
+        self.pending.append(Task(states, n_samples, fn, args, kwargs))
+
+    def observe(self, task, iters):
+        """ Feeds the iterations of each fit of a completed task back into the cost model. """
+        self.model.observe(task.states, task.n_samples, iters, task.seconds)
+
+    def _submit(self, running):
+        others = self.pending + list(running)
+        ready = {}
+        for task in self.pending:
+            task.predicted = self.model.predict(task.states, task.n_samples)
+            ready[task] = self.waits is None or not any(self.waits(task, other)
+                                                        for other in others if other is not task)
+        self.pending.sort(key=lambda task: (ready[task], task.predicted))
+        task = self.pending.pop()
+        if self.prepare is not None:
+            self.prepare(task)
+        task.submitted = t.time()
+        return self.ex.submit(task.fn, *task.args, **task.kwargs), task
+
+    def as_completed(self):
+        """ Yields (task, future) as they complete, submitting the most expensive task next. """
+        running = {}
+        start = t.time()
+        while self.pending or running:
+            while self.pending and len(running) < self.slots:
+                fut, task = self._submit(running.values())
+                running[fut] = task
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            now = t.time()
+            for fut in done:
+                task = running.pop(fut)
+                task.seconds = now - task.submitted
+                self.busy += task.seconds
+                yield task, fut
+        self.wall = t.time() - start
+
+    @property
+    def utilisation(self):
+        """ Fraction of the time workers were busy, once as_completed() is exhausted. """
+        return self.busy / (self.slots * self.wall) if self.wall else 0.
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Checks that the variants of the native engine agree with the plain batched fit (and the
+plain fit with hmmlearn), within the tolerances below. Run with python -m pytest.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+import baumwelch
+import obsfile
+from alv.intv import rle
+
+# Same start and iterations: only the order of the floating point operations differs
+ATOL = 1e-10
+
+
+def sample(lengths, n_states=3, n_features=4, stay=0.9, random_state=0):
+    """ Concatenated trials of the given lengths, drawn from a random sticky HMM. """
+    rs = np.random.RandomState(random_state)
+    transmat = np.full((n_states, n_states), (1 - stay) / (n_states - 1))
+    np.fill_diagonal(transmat, stay)
+    emissionprob = baumwelch.normalize(rs.rand(n_states, n_features) ** 3, axis=1)
+    series = []
+    for T in lengths:
+        s = rs.randint(n_states)
+        for _ in range(T):
+            series.append(rs.choice(n_features, p=emissionprob[s]))
+            s = rs.choice(n_states, p=transmat[s])
+    return np.array(series, dtype=np.int8), np.asarray(lengths)
+
+
+def fitted(X, lengths, n_iter=15, **kwargs):
+    m = baumwelch.CategoricalHMM(3, n_iter=n_iter, tol=1e-12, random_state=1, **kwargs)
+    return m.fit(X, lengths)
+
+
+def assert_same_fit(m, ref, atol=ATOL):
+    assert m.monitor_.iter == ref.monitor_.iter
+    np.testing.assert_allclose(m.monitor_.history, ref.monitor_.history, rtol=0, atol=atol)
+    for a, b in [(m.startprob_, ref.startprob_), (m.transmat_, ref.transmat_),
+                 (m.emissionprob_, ref.emissionprob_)]:
+        np.testing.assert_allclose(a, b, rtol=0, atol=atol)
+
+
+@pytest.fixture(scope='module')
+def data():
+    return sample([300, 300, 200, 300, 250, 200])
+
+
+def test_hmmlearn(data):
+    hmm = pytest.importorskip('hmmlearn.hmm')
+    X, lengths = data
+    start = baumwelch.CategoricalHMM(3, random_state=1)._init(baumwelch.as_batches(X, lengths))
+    # MultinomialHMM is the categorical model up to hmmlearn 0.2, CategoricalHMM after
+    ref = getattr(hmm, 'CategoricalHMM', hmm.MultinomialHMM)(n_components=3, n_iter=15,
+                                                            tol=1e-12, init_params='')
+    m = baumwelch.CategoricalHMM(3, n_iter=15, tol=1e-12, init_params='')
+    for model in m, ref:
+        model.n_features = int(X.max()) + 1
+        model.startprob_, model.transmat_, model.emissionprob_ = [p[0] for p in start]
+    ref.fit(X[:, None], lengths)
+    m.fit(X, lengths)
+    np.testing.assert_allclose(m.monitor_.history[-1], ref.monitor_.history[-1], rtol=0, atol=ATOL)
+    for a, b in [(m.startprob_, ref.startprob_), (m.transmat_, ref.transmat_),
+                 (m.emissionprob_, ref.emissionprob_)]:
+        np.testing.assert_allclose(a, b, rtol=0, atol=ATOL)
+    np.testing.assert_allclose(m.score(X, lengths), ref.score(X[:, None], lengths), rtol=0,
+                               atol=ATOL)
+    np.testing.assert_array_equal(m.predict(X, lengths), ref.predict(X[:, None], lengths))
+
+
+def test_runs(data):
+    X, lengths = data
+    ref = fitted(X, lengths)
+    m = baumwelch.CategoricalHMM(3, n_iter=15, tol=1e-12, random_state=1)
+    m.n_features = ref.n_features
+    assert_same_fit(m.fit_runs(rle(X), lengths), ref)
+    np.testing.assert_allclose(ref.score_runs(rle(X), lengths), ref.score(X, lengths), rtol=0,
+                               atol=ATOL)
+
+
+@pytest.mark.parametrize('mapped', [False, True])
+def test_time_blocks(data, tmpdir, mapped):
+    X, lengths = data
+    ref = fitted(X, lengths)
+    if mapped:  # Blocks are then read from this file by the workers
+        obsfile.write(str(tmpdir.join('series.obs')), X, lengths)
+        X = obsfile.load(str(tmpdir.join('series.obs')))[0]
+    m = fitted(X, lengths, time_blocks=4)
+    assert_same_fit(m, ref)
+    np.testing.assert_allclose(m.score(X, lengths), ref.score(X, lengths), rtol=0, atol=ATOL)
+    (lp, path), (ref_lp, ref_path) = m.decode(X, lengths), ref.decode(X, lengths)
+    m.close()
+    np.testing.assert_allclose(lp, ref_lp, rtol=0, atol=ATOL)
+    np.testing.assert_array_equal(path, ref_path)
+
+
+def test_threads(data):
+    X, lengths = data
+    assert_same_fit(fitted(X, lengths, n_threads=3), fitted(X, lengths))
+
+
+@pytest.mark.parametrize('folds', [[0, 0, 1, 1, 2, 2], [0, 1, 2, 0, 1, 2]])
+def test_folds(data, folds):
+    X, lengths = data
+    folds = np.array(folds)
+    models = baumwelch.fit_folds(X, lengths, folds, 3, n_iter=15, tol=1e-12, random_state=1)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    init = baumwelch.CategoricalHMM(3, random_state=1, n_restarts=3)._init(
+        baumwelch.as_batches(X, lengths))
+    for f, m in enumerate(models):
+        train = folds != f
+        ref = baumwelch.CategoricalHMM(3, n_iter=15, tol=1e-12, init_params='')
+        ref.n_features = m.n_features
+        ref.startprob_, ref.transmat_, ref.emissionprob_ = [p[f] for p in init]
+        ref.fit(np.concatenate([X[offsets[i]:offsets[i + 1]] for i in np.flatnonzero(train)]),
+                lengths[train])
+        assert_same_fit(m, ref)
+
+
+def test_sparse_transmat():
+    rs = np.random.RandomState(2)
+    K, n = 30, 5
+    transmat = baumwelch.normalize(rs.rand(K, K) * (np.eye(K) + np.eye(K, k=1) + np.eye(K, k=-1)),
+                                   axis=1)
+    A = baumwelch.as_transitions(transmat)
+    assert isinstance(A, baumwelch.SparseTransmat)
+    framelik = rs.rand(50, n, K)
+    startprob = baumwelch.normalize(rs.rand(K))
+    alpha, scale = baumwelch.forward(framelik, startprob, transmat)
+    sparse_alpha, sparse_scale = baumwelch.forward(framelik, startprob, A)
+    np.testing.assert_allclose(sparse_alpha, alpha, rtol=0, atol=ATOL)
+    np.testing.assert_allclose(sparse_scale, scale, rtol=1e-12)
+    np.testing.assert_allclose(baumwelch.backward(framelik, A, scale),
+                               baumwelch.backward(framelik, transmat, scale), rtol=1e-12)
+    with np.errstate(divide='ignore'):
+        framelogprob = np.log(framelik)
+    np.testing.assert_array_equal(baumwelch.viterbi(framelogprob, startprob, A)[0],
+                                  baumwelch.viterbi(framelogprob, startprob, transmat)[0])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 500])
+def test_stream_viterbi(data, chunk_size):
+    X = data[0][:data[1][0]]
+    m = fitted(X, None)
+    chunks = (X[a:a + chunk_size] for a in range(0, X.size, chunk_size))
+    path = np.concatenate(list(baumwelch.stream_viterbi(chunks, m.startprob_, m.transmat_,
+                                                        m.emissionprob_)))
+    np.testing.assert_array_equal(path, m.predict(X))
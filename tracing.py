@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+Timing events of the phases of a run (loading, fitting and every EM iteration, decoding,
+scoring, saving, sending results between processes), for profiling.
+
+Nothing is recorded until enable() is called. Each process then collects its own events,
+tagged with the current k and fold (see tagged()). Functions run by worker processes are
+wrapped with task(), which sends their events back along with their result, so that the
+parent ends up with the events of the whole run:
+
+    enable()
+    fut = ex.submit(task(fn), *args)
+    result = collect(fut.result(), submitted)
+    ...
+    write(path)
+    print(summary())
+"""
+from __future__ import print_function, division
+import json
+import os
+import pickle
+import time as t
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import partial
+
+_events = []
+_tags = {}
+_enabled = False
+
+
+def enable():
+    """ Starts recording events in this process. """
+    global _enabled
+    _enabled = True
+
+
+def emit(phase, **fields):
+    """ Records an event of the given phase, with the current tags and any other fields. """
+    if not _enabled:
+        return None
+    event = dict(_tags, phase=phase, pid=os.getpid(), time=t.time())
+    event.update(fields)
+    _events.append(event)
+    return event
+
+
+@contextmanager
+def span(phase, **fields):
+    """ Records an event with the seconds spent in the block, e.g. with span('decode'): ... """
+    tick = t.time()
+    yield
+    emit(phase, seconds=t.time() - tick, **fields)
+
+
+@contextmanager
+def tagged(**tags):
+    """ Adds tags (e.g. k=3, fold=0) to all events recorded within the block. """
+    previous = _tags.copy()
+    _tags.update(tags)
+    try:
+        yield
+    finally:
+        _tags.clear()
+        _tags.update(previous)
+
+
+def iterations(monitor, **fields):
+    """
+    Records one event per EM iteration of a baumwelch.Monitor, with its log-likelihood,
+    its improvement over the previous iteration and its duration.
+    """
+    times = getattr(monitor, 'times', None)
+    if not _enabled or not times:  # e.g. hmmlearn
+        return
+    history = monitor.history[-len(times):]
+    ends = [monitor.start] + list(times)
+    offset = len(monitor.history) - len(times)
+    for i, logprob in enumerate(history):
+        previous = monitor.history[offset + i - 1] if offset + i else None
+        emit('iteration', iter=offset + i + 1, logprob=logprob,
+             delta=None if previous is None else logprob - previous,
+             seconds=ends[i + 1] - ends[i], **fields)
+
+
+def drain():
+    """ Returns the events recorded so far in this process and forgets them. """
+    events = list(_events)
+    del _events[:]
+    return events
+
+
+def task(fn):
+    """ fn wrapped with traced() to run in a worker process if recording, else fn itself. """
+    return partial(traced, fn) if _enabled else fn
+
+
+def traced(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) in a worker process, recording its events. Returns the result
+    with the events it recorded, the time taken to pickle the result and the start and end
+    times, see collect().
+    """
+    enable()
+    drain()  # Events from earlier tasks in the same worker have been sent already
+    start = t.time()
+    result = fn(*args, **kwargs)
+    tick = t.time()
+    size = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    emit('pickle', seconds=t.time() - tick, bytes=size)
+    return {'result': result, 'events': drain(), 'start': start, 'end': t.time()}
+
+
+def collect(out, submitted=None):
+    """
+    Adds the events of a traced() task to those of this process, with a 'queue' event
+    (from submission until it started running, if submitted is known) and a 'transfer'
+    event (from its end until its result was received here). Returns the result of the task,
+    which is out itself if not recording (see task()).
+    """
+    if not _enabled:
+        return out
+    _events.extend(out['events'])
+    pid = out['events'][-1]['pid'] if out['events'] else None
+    if submitted is not None:
+        emit('queue', seconds=out['start'] - submitted, worker=pid)
+    emit('transfer', seconds=t.time() - out['end'], worker=pid)
+    return out['result']
+
+
+def write(path, events=None):
+    """ Writes events (all of those of this process by default) as JSON lines. """
+    with open(path, 'w') as f:
+        for event in _events if events is None else events:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+def summary(events=None):
+    """
+    Table of the time spent in each phase (number of events, total, mean and maximum
+    seconds), followed by the number of EM iterations and seconds per iteration for each k.
+    """
+    events = _events if events is None else events
+    phases = OrderedDict()
+    for e in events:
+        if e.get('seconds') is not None:
+            phases.setdefault(e['phase'], []).append(e['seconds'])
+    lines = ['{:<12} {:>8} {:>12} {:>12} {:>12}'.format('phase', 'count', 'total (s)', 'mean (s)',
+                                                        'max (s)')]
+    for phase, seconds in phases.items():
+        lines.append('{:<12} {:>8d} {:>12.3f} {:>12.4f} {:>12.4f}'.format(
+            phase, len(seconds), sum(seconds), sum(seconds) / len(seconds), max(seconds)))
+    per_k = {}
+    for e in events:
+        if e['phase'] == 'iteration':
+            per_k.setdefault(e.get('k'), []).append(e['seconds'])
+    if per_k:
+        lines += ['', '{:<12} {:>8} {:>12} {:>12}'.format('k', 'fits', 'iterations', 's/iteration')]
+        fits = {}
+        for e in events:
+            if e['phase'] == 'fit':
+                fits[e.get('k')] = fits.get(e.get('k'), 0) + 1
+        for k in sorted(per_k):
+            lines.append('{:<12} {:>8d} {:>12d} {:>12.5f}'.format(
+                str(k), fits.get(k, 0), len(per_k[k]), sum(per_k[k]) / len(per_k[k])))
+    return '\n'.join(lines)